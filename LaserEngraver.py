@@ -15,6 +15,7 @@ but your gcode has to support this
 """
 #import pyximport
 #pyximport.install()
+import os
 import sys
 import logging
 logging.basicConfig(level=logging.INFO, format="%(message)s")
@@ -33,6 +34,7 @@ from GPIOWrapper import GPIOWrapper as gpio
 #from LaserSimulator import LaserSimulator
 from GuiConsole import GuiConsole as GuiConsole
 from Parser import Parser
+from ParserCache import ParserCache
 #import ControllerExit
 from StepDirMotor import StepDirMotor
 from LaserMotor import LaserMotor
@@ -40,6 +42,9 @@ from BaseSpindle import BaseSpindle
 from Controller import Controller
 from Transformer import Transformer
 
+# parsed G-Code files are cached here
+CACHE_DIRECTORY = os.path.expanduser("~/.cache/python-gcode")
+
 GPIO.OUT
 def main(): 
     if len(sys.argv) == 1:
@@ -91,6 +96,7 @@ def main():
     logging.info("Creating Parser Object")
     parser = Parser(filename=sys.argv[1], autorun=False)
     parser.set_controller(controller)
+    parser.set_cache(ParserCache(CACHE_DIRECTORY))
     # create gui
     logging.info("Creating GUI")
     # gui = LaserSimulator(automatic=True, zoom=10.0, controller=controller, parser=parser)
@@ -103,9 +109,10 @@ def main():
     # STEP 3 - run 
     # this is usually done from
     try:
-        parser.read()
+        # packed program, from cache if this file was parsed before
+        program = parser.read_program()
         #key = raw_input("Parsing done, press Return to call controller")
-        parser.run()
+        controller.consume_program(program)
         #key = raw_input("Controller calculations done, press Return to move")
         controller.run()
         key = raw_input("Controller calculations done, press Return to move")
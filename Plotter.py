@@ -49,6 +49,7 @@ from UnipolarStepperMotor import UnipolarStepperMotor as UnipolarStepperMotor
 from BaseSpindle import BaseSpindle as BaseSpindle
 from Controller import Controller as Controller
 from Transformer import PlotterTransformer as PlotterTransformer
+from Pipeline import Pipeline as Pipeline
 #from PlotterSimulator import PlotterSimulator as PlotterSimulator
 from GuiConsole import GuiConsole as GuiConsole
 
@@ -112,7 +113,7 @@ def main():
         controller.add_motor("Y", motor_y)
         controller.add_motor("Z", motor_z)
         controller.add_spindle(BaseSpindle()) # generic spindle object
-        transformer = PlotterTransformer(width=830, scale=15.0, ca_zero=320, h_zero=140) # transformer for plotter usage
+        transformer = PlotterTransformer(width=830, scale=15.0, ca_zero=320, h_zero=140, absolute=True) # transformer for plotter usage
         controller.add_transformer(transformer) # transformer for plotter usage
         # create parser
         logging.info("Creating Parser Object")
@@ -131,12 +132,10 @@ def main():
         # start
         logging.info("Please move pen to left top corner, the origin")
         # key = raw_input("Press any KEY when done")
-        logging.error("start parsing")
-        parser.read()
-        logging.error("parsing done, calling controller methods")
-        parser.run()
-        logging.error("controller calculations done, calling physical world")
-        controller.run()
+        # parsing, controller calculations and physical world at the same time
+        logging.error("start pipeline")
+        Pipeline(parser, controller).run()
+        logging.error("pipeline done")
         gui.quit()
     except KeyboardInterrupt as exc:
         logging.info(exc)
@@ -18,10 +18,16 @@ extensions = [
     Extension("BaseMotor", ["src/Motor/BaseMotor.pyx"], extra_compile_args=extra_compile_args),
     Extension("UnipolarStepperMotor", ["src/Motor/UnipolarStepperMotor.pyx"], extra_compile_args=extra_compile_args),
     Extension("BipolarStepperMotor", ["src/Motor/BipolarStepperMotor.pyx"], extra_compile_args=extra_compile_args),
+    Extension("StepScheduler", ["src/Motor/StepScheduler.pyx"], extra_compile_args=extra_compile_args),
     Extension("LaserMotor", ["src/Motor/LaserMotor.pyx"], extra_compile_args=extra_compile_args),
     Extension("A5988DriverMotor", ["src/Motor/A5988DriverMotor.pyx"], extra_compile_args=extra_compile_args),
     Extension("StepDirMotor", ["src/Motor/StepDirMotor.pyx"], extra_compile_args=extra_compile_args),
     Extension("Parser", ["src/Parser.pyx"], extra_compile_args=extra_compile_args),
+    Extension("ParserCache", ["src/ParserCache.pyx"], extra_compile_args=extra_compile_args),
+    Extension("Planner", ["src/Planner.pyx"], extra_compile_args=extra_compile_args),
+    Extension("StepBuffer", ["src/StepBuffer.pyx"], extra_compile_args=extra_compile_args),
+    Extension("Pipeline", ["src/Pipeline.pyx"], extra_compile_args=extra_compile_args),
+    Extension("StepExecutor", ["src/StepExecutor.pyx"], extra_compile_args=extra_compile_args),
     Extension("Point3d", ["src/Point3d.pyx"], extra_compile_args=extra_compile_args),
     Extension("LaserSpindle", ["src/Spindle/LaserSpindle.pyx"], extra_compile_args=extra_compile_args),
     Extension("BaseSpindle", ["src/Spindle/BaseSpindle.pyx"], extra_compile_args=extra_compile_args),
@@ -35,5 +41,6 @@ extensions = [
 
 setup(
     name = "python-gcode",
-    ext_modules = cythonize(extensions), # accepts a glob pattern
+    # Point3d.pxd is cimported from modules in subdirectories too
+    ext_modules = cythonize(extensions, include_path=["src"]), # accepts a glob pattern
 )
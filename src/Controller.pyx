@@ -9,8 +9,28 @@ logging.basicConfig(level=logging.INFO, format="%(message)s")
 # import inspect
 import math
 import time
+import threading
+import multiprocessing
+from libc.math cimport lround, sin, cos, acos, atan2, hypot, ceil, fabs, M_PI
+from libc.stdlib cimport labs
 # own modules
-from Point3d import Point3d as Point3d
+from Point3d cimport Point3d, PointArray, vec3, vec3_new, vec3_add, vec3_sub, vec3_mul, vec3_length, vec3_is_zero, vec3_point
+from StepBuffer import StepBuffer as StepBuffer
+from StepScheduler import StepScheduler as StepScheduler
+from BaseMotor import StepTimer as StepTimer
+# numpy is optional, steps are calculated one by one without it
+try:
+    from Planner import SegmentPlanner as SegmentPlanner
+    from Planner import plan_chunk as plan_chunk
+except ImportError:
+    SegmentPlanner = None
+
+# maximum number of halvings of a move for non-linear transformers
+MAX_SUBDIVISION_DEPTH = 16
+
+# default acceleration in mm/s^2 and junction deviation in mm for the segment planner
+ACCELERATION = 50.0
+JUNCTION_DEVIATION = 0.05
 
 
 class ControllerExit(Exception):
@@ -25,6 +45,40 @@ class ControllerCommandNotImplemented(Exception):
         Exception.__init__(self, *args)
 
 
+cdef str normalize_code(str methodname):
+    """
+    return G-, M-Code name without leading zeros, G01 -> G1, M03 -> M3
+    """
+    cdef str number = methodname[1:].lstrip("0")
+    if len(methodname) == 1:
+        return(methodname)
+    if len(number) == 0 or number[0] == ".":
+        number = "0" + number
+    return(methodname[0] + number)
+
+
+cdef class UnsupportedCommand(object):
+    """
+    handler for G- or M-Codes without implementation in Controller,
+    calls are only counted
+    """
+
+    cdef public str methodname
+    cdef public long count
+
+    def __init__(self, str methodname):
+        self.methodname = methodname
+        self.count = 0
+
+    def __call__(self, *args):
+        self.count += 1
+
+
+cdef inline vec3 as_vec3(object xyz):
+    """return vec3 of sequence x, y, z"""
+    return(vec3_new(xyz[0], xyz[1], xyz[2]))
+
+
 cdef class Controller(object):
     """
     Class to receive Gcode Commands and Statements and translate
@@ -36,14 +90,28 @@ cdef class Controller(object):
     for all of them there are No-Action Classes to serve as placeholder
     """
 
-    cdef double resolution, angle_step, angle_step_sin, angle_step_cos
+    cdef double resolution, arc_tolerance, junction_deviation, kinematics_tolerance
+    cdef int linear
     cdef double feed, default_speed, speed
-    cdef int autorun, tool
+    cdef int autorun, tool, incremental, rapid
     cdef list commands
     cdef object spindle, gui_cb, transformer
     cdef object __caller, __linear_move
+    cdef double step_target[3]
+    cdef long step_position[3]
+    cdef object scheduler
+    cdef object planner
+    cdef object steps
+    cdef object executor
+    cdef object pool
+    cdef int processes
+    cdef list pending
+    cdef dict handlers
+    cdef list unsupported
     cdef public dict motors
-    cdef public object position
+    cdef public object stop
+    cdef public object timer
+    cdef vec3 current
 
     def __init__(self, double resolution, int default_speed, int autorun):
         """
@@ -55,7 +123,8 @@ cdef class Controller(object):
             TODO -> should be in Spindle class
         autorun -> in True perform motor commands immediately
             if False, motor command are stored in self.commands
-            and can be executed independently
+            and can be executed independently, motor steps
+            are packed in StepBuffers
         """
         self.default_speed = default_speed
         self.resolution = resolution
@@ -64,33 +133,174 @@ cdef class Controller(object):
         # to prevent if switches in functions
         if self.autorun is True:
             self.__caller = self.__caller_autorun
+            self.steps = None
         else:
             self.__caller = self.__caller_norun
+            self.steps = StepBuffer()
         # initialize position
-        self.position = Point3d(0, 0, 0)
+        self.current = vec3_new(0.0, 0.0, 0.0)
         # defaults to absolute movements
         self.__linear_move = self.__linear_move_abs
+        self.incremental = False
         # defaults to millimeter
         # DELETE self.unit = "millimeter"
         # motors dict
         self.motors = {}
+        # emits steps of X, Y, Z motor together
+        self.scheduler = StepScheduler()
+        # timeline of steps, with jitter histogram
+        self.timer = StepTimer()
+        # exact position in motor steps, and steps actually done
+        for axis in range(3):
+            self.step_target[axis] = 0.0
+            self.step_position[axis] = 0
+        # segment planner, if available
+        self.planner = None
+        self.junction_deviation = JUNCTION_DEVIATION
+        if SegmentPlanner is not None:
+            self.planner = SegmentPlanner()
+            self.set_acceleration(ACCELERATION, JUNCTION_DEVIATION)
         self.spindle = None
         # GUI Callback method, called after every g-command
         self.gui_cb = None
-        # Feed Rate
+        # Feed Rate in units per minute, and G00 in progress
         self.feed = 0
+        self.rapid = False
         # Speed
         self.speed = 0
         # Tool
         self.tool = 1
-        # define minimal arc step
-        self.angle_step = math.pi / 180 
-        self.angle_step_sin = math.sin(self.angle_step)
-        self.angle_step_cos = math.cos(self.angle_step)
-        # optional a tranforming function
+        # maximum distance of arc segments to exact arc in mm
+        self.arc_tolerance = 0.01
+        # optional a tranforming function, and if it keeps lines straight
         self.transformer = None
+        self.linear = True
+        # maximum distance in motor steps between the exact path of a
+        # non-linear transformer and the segments actually moved
+        self.kinematics_tolerance = 0.5
         # list of motor commands
         self.commands = []
+        # set to stop execution of motor commands
+        self.stop = threading.Event()
+        # optional StepExecutor process
+        self.executor = None
+        # optional worker processes for the segment planner, and chunks in work
+        self.pool = None
+        self.processes = 0
+        self.pending = []
+        # dispatch table, G-, M-Code, F, S and T to bound method
+        self.handlers = {}
+        for methodname in dir(type(self)):
+            if methodname in ("F", "S", "T") or (methodname[0] in ("G", "M") and methodname[1:].isdigit()):
+                self.handlers[normalize_code(methodname)] = getattr(self, methodname)
+        # handlers of unknown codes
+        self.unsupported = []
+
+    cpdef object get_handler(self, str methodname):
+        """
+        return method to call for G-, M-Code, F, S or T given as methodname
+        like G01, G1, M03 or F
+
+        codes without implementation get an UnsupportedCommand handler,
+        which counts the calls, see report_unsupported()
+        """
+        cdef object handler
+        try:
+            return(self.handlers[methodname])
+        except KeyError:
+            pass
+        handler = self.handlers.get(normalize_code(methodname))
+        if handler is None:
+            handler = UnsupportedCommand(normalize_code(methodname))
+            self.handlers[normalize_code(methodname)] = handler
+            self.unsupported.append(handler)
+        # remember spelling
+        self.handlers[methodname] = handler
+        return(handler)
+
+    cpdef int report_unsupported(self):
+        """
+        log all called codes without implementation once, with number of calls
+        """
+        cdef UnsupportedCommand handler
+        for handler in self.unsupported:
+            if handler.count > 0:
+                logging.info("unsupported command %s called %d times", handler.methodname, handler.count)
+                handler.count = 0
+        return(0)
+
+    cpdef int flush(self):
+        """
+        hand steps of all segments collected in planner to motors,
+        ending at rest,
+        this is done automatically before any other motor or spindle call
+        """
+        return(self.__plan(True))
+
+    cdef int __plan(self, int final) except -1:
+        """
+        hand steps of segments collected in planner to motors,
+        if not final, the last segments stay in the planner, so that
+        there is no stop at rest before the next segments
+        """
+        if self.planner is None or len(self.planner) == 0:
+            return(0)
+        if self.pool is not None:
+            # plan in worker process, steps are collected in order later
+            # speeds are planned here, so chunks join without stop
+            chunk = self.planner.take(self.__tick_delay(), final)
+            if chunk is not None:
+                self.pending.append(self.pool.apply_async(plan_chunk, (chunk, self.planner.acceleration)))
+            self.__collect(2 * self.processes)
+            return(0)
+        plan = self.planner.plan(self.__tick_delay(), final)
+        if plan is None:
+            return(0)
+        if self.steps is not None:
+            self.gui_cb()
+            plan.pack(self.steps)
+        else:
+            self.__caller(plan.run, self.scheduler, self.stop, self.timer)
+        return(0)
+
+    cdef int __collect(self, int keep) except -1:
+        """
+        append steps of planned chunks to self.steps in order,
+        until at most keep chunks are still in work
+        """
+        while len(self.pending) > keep:
+            self.steps.extend(*self.pending.pop(0).get())
+            self.gui_cb()
+        return(0)
+
+    cdef double __tick_delay(self):
+        """
+        return minimal time between two ticks, as fast as the slowest motor allows
+        """
+        cdef double delay = 0.0
+        for motor in self.motors.values():
+            delay = max(delay, motor.get_delay())
+        return(delay)
+
+    cpdef list drain(self):
+        """
+        return motor commands stored so far, and remove them from self.commands
+        segments still in the planner are not included, see flush()
+        """
+        cdef list commands
+        self.__close_steps()
+        commands = self.commands
+        self.commands = []
+        return(commands)
+
+    def abort(self):
+        """
+        stop execution of motor commands as soon as possible,
+        could be called from any thread, the next run starts again
+        """
+        self.stop.set()
+        if self.executor is not None:
+            self.executor.abort()
 
     def add_spindle(self, spindle_object):
         """add spindle to controller"""
@@ -101,10 +311,76 @@ cdef class Controller(object):
         axis should be named with capitalized letters of X, Y, Z"""
         assert axis in ("X", "Y", "Z")
         self.motors[axis] = motor_object
+        self.scheduler.set_motor("XYZ".index(axis), motor_object)
+
+    def set_executor(self, executor):
+        """
+        execute motor steps and motor and spindle calls in StepExecutor process,
+        only possible with autorun=False, commands in self.commands then
+        hand everything to executor
+        """
+        assert self.steps is not None
+        self.executor = executor
+
+    def set_workers(self, int processes):
+        """
+        plan segments in processes worker processes, only possible
+        with autorun=False and segment planner, 0 plans in this process again
+
+        speeds of every chunk of segments are planned in this process,
+        with look-ahead over the chunk boundaries, the workers only
+        calculate the steps, chunks are appended to the steps in order
+        """
+        assert self.steps is not None and self.planner is not None
+        self.close_workers()
+        if processes > 0:
+            self.pool = multiprocessing.Pool(processes)
+            self.processes = processes
+
+    def close_workers(self):
+        """wait for all chunks in work and stop worker processes"""
+        if self.pool is not None:
+            self.__collect(0)
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+            self.processes = 0
 
     def add_transformer(self, transformer):
         """add transformer"""
         self.transformer = transformer
+        self.linear = transformer.is_linear()
+
+    def set_acceleration(self, double acceleration, double junction_deviation):
+        """
+        maximum acceleration in mm/s^2, 0.0 means no limit
+        and allowed deviation from the exact corner in mm at the junction
+        of two segments, only used by the segment planner,
+        junction_deviation is used again by G61, G64 without P and every new run
+        """
+        assert acceleration >= 0.0
+        assert 0.0 <= junction_deviation < float("inf")
+        self.junction_deviation = junction_deviation
+        if self.planner is not None:
+            self.planner.acceleration = acceleration
+            self.planner.junction_deviation = junction_deviation
+
+    def set_kinematics_tolerance(self, double tolerance):
+        """
+        maximum distance in motor steps between the exact path of a
+        non-linear transformer and the linear segments in motor positions,
+        moves are split as often as needed to stay within
+        """
+        assert tolerance > 0.0
+        self.kinematics_tolerance = tolerance
+
+    def set_arc_tolerance(self, double tolerance):
+        """
+        maximum distance between the exact arc and its linear segments
+        for G02 and G03 in mm
+        """
+        assert tolerance > 0.0
+        self.arc_tolerance = tolerance
 
     def set_gui_cb(self, gui_cb):
         """
@@ -112,6 +388,15 @@ cdef class Controller(object):
         """
         self.gui_cb = gui_cb
 
+    @property
+    def position(self):
+        """own position as new Point3d"""
+        return(vec3_point(self.current))
+
+    @position.setter
+    def position(self, Point3d position):
+        self.current = position.vec()
+
     def get_position(self):
         """return own position"""
         return(self.position)
@@ -132,35 +417,32 @@ cdef class Controller(object):
 
     def G00(self, *args):
         """rapid motion with maximum speed"""
+        self.rapid = True
         self.__linear_move(args[0])
     G0 = G00
 
     def G01(self, *args):
         """linear motion with given speed"""
+        self.rapid = False
         self.__linear_move(args[0])
     G1 = G01
 
     def G02(self, *args):
         """clockwise helical motion"""
-        data = args[0]
-        data["F"] = self.default_speed if "F" not in data else data["F"]
-        data["P"] = 1 if "P" not in data else data["P"]
-        assert type(data["P"]) == int
-        self.__arc(data, -1)
+        self.rapid = False
+        self.__arc(args[0], -1)
     G2 = G02
 
     def G03(self, *args):
         """counterclockwise helical motion"""
-        data = args[0]
-        data["F"] = self.default_speed if "F" not in data else data["F"]
-        data["P"] = 1 if "P" not in data else data["P"]
-        assert type(data["P"]) == int
-        self.__arc(data, 1)
+        self.rapid = False
+        self.__arc(args[0], 1)
     G3 = G03
 
     def G04(self, *args):
         """Dwell (no motion for P seconds)"""
         logging.info("G04 called with %s", args)
+        self.flush()
         if "P" in args[0]:
             time.sleep(args[0]["P"])
     G4 = G04
@@ -189,15 +471,48 @@ cdef class Controller(object):
         """Select coordinate system"""
         logging.info("G54 called with %s", args)
 
+    def G61(self, *args):
+        """Exact path mode, stop at the end of every segment"""
+        logging.info("G61 called with %s", args)
+        if self.planner is None:
+            logging.warning("G61 ignored, there is no segment planner without numpy")
+            return
+        self.flush()
+        self.planner.exact_stop = True
+        self.planner.junction_deviation = self.junction_deviation
+
+    def G64(self, *args):
+        """
+        Path control mode, corners are passed without stop
+
+        the path still goes exactly through every corner, P is used as
+        junction deviation of the segment planner, the distance of an arc
+        through the corner, that would allow the planned corner speed,
+        so a bigger P means faster corners, not rounded ones,
+        without P the junction deviation from set_acceleration is used
+        """
+        logging.info("G64 called with %s", args)
+        if self.planner is None:
+            logging.warning("G64 ignored, there is no segment planner without numpy")
+            return
+        tolerance = args[0].get("P", self.junction_deviation)
+        if not 0.0 <= tolerance < float("inf"):
+            raise ValueError("G64 P%s is not a distance of 0 or more" % tolerance)
+        self.flush()
+        self.planner.exact_stop = False
+        self.planner.junction_deviation = tolerance
+
     def G90(self, *args):
         """Absolute distance mode"""
         logging.info("G90 called with %s", args)
         self.__linear_move = self.__linear_move_abs
+        self.incremental = False
 
     def G91(self, *args):
         """Incremental distance mode"""
         logging.info("G91 called with %s", args)
         self.__linear_move = self.__linear_move_inc
+        self.incremental = True
 
     def G94(self, *args):
         """Units per minute feed rate"""
@@ -248,149 +563,120 @@ cdef class Controller(object):
         """called at end of G-Code commands
         to move to origin and poweroff everything"""
         # back to origin
-        self.__goto(Point3d(0, 0, 0))
+        self.__goto(vec3_new(0.0, 0.0, 0.0))
         # unhold everything
         for axis in self.motors.keys():
             self.__motor_caller(axis, "unhold")
         # stop spindle
         self.__spindle_caller("unhold")
+        self.report_unsupported()
 
-    cdef object __get_center(self, object target, double radius):
+    cdef vec3 __get_center(self, vec3 target, double radius) except *:
         """
         helper method for G02 and G03 called to get center of arc
         get center from target on circle and radius given
         """
-        cdef object distance = target - self.position
-        cdef double h_x2_div_d = math.sqrt(4 * radius **2 - distance.X**2 - distance.Y**2) / math.sqrt(distance.X**2 + distance.Y**2)
-        cdef double i = (distance.X - (distance.Y * h_x2_div_d))/2
-        cdef double j = (distance.Y + (distance.X * h_x2_div_d))/2
-        return(Point3d(i, j, 0.0))
+        cdef vec3 distance = vec3_sub(target, self.current)
+        cdef double h_x2_div_d = math.sqrt(4 * radius **2 - distance.axis[0]**2 - distance.axis[1]**2) / math.sqrt(distance.axis[0]**2 + distance.axis[1]**2)
+        cdef double i = (distance.axis[0] - (distance.axis[1] * h_x2_div_d))/2
+        cdef double j = (distance.axis[1] + (distance.axis[0] * h_x2_div_d))/2
+        return(vec3_new(i, j, 0.0))
 
     cdef __arc(self, dict data, int ccw):
         """
-        given actual position and 
-        x, y, z relative position of stop point on arc
-        i, j, k relative position of center
-
-        i am not sure if this implementation is straight forward enough
-        semms more hacked than mathematically correct
-        TODO: Improve
-        """
-        # correct some values if not specified
-        if "X" not in data: data["X"] = self.position.X
-        if "Y" not in data: data["Y"] = self.position.Y
-        if "Z" not in data: data["Z"] = self.position.Z
-        if "I" not in data: data["I"] = 0.0
-        if "J" not in data: data["J"] = 0.0
-        if "K" not in data: data["K"] = 0.0
+        given actual position and
+        x, y, z absolute position of stop point on arc
+        i, j relative position of center, or radius r
+        p number of turns, defaults to 1
+
+        the arc is split in segments of the same angle, so many that
+        the chord error stays below arc_tolerance, z is moved linear
+        along the arc for helical motion
+
+        same start and stop point is a full circle
+        """
+        cdef double x0 = self.current.axis[0]
+        cdef double y0 = self.current.axis[1]
+        cdef double z0 = self.current.axis[2]
+        cdef double x1 = data.get("X", x0)
+        cdef double y1 = data.get("Y", y0)
+        cdef double z1 = data.get("Z", z0)
+        cdef double cx, cy, radius, start_angle, sweep, segment_angle, angle
+        cdef int segments, index
         # arc endpoint at X/Y/Z
-        cdef object target = Point3d(data["X"], data["Y"], data["Z"])
-        # calculate endpoint of arc, either given in
-        # I/J/K position or R
-        cdef object offset
+        cdef vec3 target = vec3_new(x1, y1, z1)
+        cdef vec3 offset
+        # calculate center of arc, either given in
+        # I/J position or R
         if "R" in data:
             offset = self.__get_center(target, data["R"])
         else:
-            offset = Point3d(data["I"], data["J"], data["K"])
-        #startpoint and endpoint are known, so calculate midpoint
-        cdef object center = self.position + offset
-        # get the angle bewteen
-        # unit vector from mid to target
-        # unit vector from mid to actual position
-        cdef object target_vec = (target - center).unit()
-        cdef object position_vec = (self.position - center).unit()
-        cdef double angle = target_vec.angle_between(position_vec)
-        # next trigonometry
-        #logging.debug("angle between target and position is %s", target_vec.angle_between(position_vec))
-        cdef double start_angle
-        cdef double stop_angle
-        cdef double angle_step = math.pi / 180
-        # shortcut, if angle is smaller than angle_step,
-        # make a straight line
-        if abs(angle) <= self.angle_step:
+            offset = vec3_new(data.get("I", 0.0), data.get("J", 0.0), 0.0)
+        cx = x0 + offset.axis[0]
+        cy = y0 + offset.axis[1]
+        radius = hypot(x0 - cx, y0 - cy)
+        if radius == 0.0:
             self.__goto(target)
             return
-        # according to count/non-counter clockwise
-        # and actual position and target
-        # calculate starting and stop angle adn stepsize
-        cdef double target_angle = target_vec.angle()
-        cdef double position_angle = position_vec.angle()
+        # angle to sweep, positive for G3, negative for G2
+        start_angle = atan2(y0 - cy, x0 - cx)
+        sweep = atan2(y1 - cy, x1 - cx) - start_angle
         if ccw == 1:
-            # G3 movement
-            # angle step will be added
-            # target angle should be greater than position angle
-            # if not so correct target_angle = 2 * math.pi - target_angle 
-            if target_angle < position_angle:
-                start_angle = position_angle
-                stop_angle = 2 * math.pi - target_angle
-            else:
-                start_angle = position_angle
-                stop_angle = target_angle
+            if sweep <= 1e-9:
+                sweep += 2 * M_PI
         else:
-            # G2 movement
-            # so clockwise, step must be negative
-            # target angle should be smaller than position angle
-            # if not correct target_angle = 2 * math.pi - target_angle
-            angle_step = -angle_step
-            # should go from position to target
-            if target_angle > position_angle:
-                start_angle = position_angle
-                stop_angle = 2 * math.pi - target_angle
-            else:
-                start_angle = position_angle
-                stop_angle = target_angle
-        # if start equals end this indicates a full circle
-        if start_angle == stop_angle:
-            stop_angle += math.pi * 2
-        # well done, positions and angle are known
-        # what is the stepsize in degree
-        cdef int angle_steps = abs(int((start_angle - stop_angle) / angle_step))
-        cdef object inv_offset = offset * -1
-        angle = angle_step * angle_steps
-        cdef double cos_theta = math.cos(angle_step)
-        cdef double sin_theta = math.sin(angle_step)
-        while abs(angle) > abs(angle_step):
-            inv_offset = inv_offset.rotated_z_fast(angle_step, cos_theta, sin_theta)
-            self.__goto(center + inv_offset)
-            angle -= angle_step
-        # rotate last tiny fraction left
-        inv_offset = inv_offset.rotated_Z(angle_step)
-        self.__goto(center + inv_offset)
-        self.__drift_management(target)
-
-    cdef __drift_management(self, object target):
-        """
-        can be called to get closer to target
-        drift is calculated as vector between actual position and target
-        the length of the drift vector should always be under 1
-
-        the remaining drift vector is moved to get as close as possible to target
-
-        Note: 
-            there will always be a small gap between actual position and wanted target,
-            because motors only can move in whole steps
-            a second source of error will be floating point operations
-        """
-        drift = self.position - target
+            if sweep >= -1e-9:
+                sweep -= 2 * M_PI
+        sweep += ccw * 2 * M_PI * (int(data.get("P", 1)) - 1)
+        # angle of segment with chord error of arc_tolerance,
+        # at least four segments for a full circle
+        segment_angle = M_PI / 2
+        if self.arc_tolerance < radius:
+            segment_angle = min(segment_angle, 2 * acos(1.0 - self.arc_tolerance / radius))
+        segments = max(1, <int>ceil(fabs(sweep) / segment_angle))
+        for index in range(1, segments):
+            angle = start_angle + sweep * index / segments
+            self.__goto(vec3_new(cx + radius * cos(angle), cy + radius * sin(angle), z0 + (z1 - z0) * index / segments))
+        # end exactly on target
         self.__goto(target)
 
-    cdef int __motor_steps(self, data):
+    cdef int __motor_tick(self, object buffer, unsigned char event, double delay) except -1:
         """
-        method to initialize single steps on the different axis
-        the size here is already steps, not units as mm or inches
-        scaling is done in __goto
+        method to initialize single steps on the different axis at once,
+        bit 0, 1, 2 of event for a step of X, Y, Z
+        and bit 4, 5, 6 if this step is in negative direction
         """
-        cdef double step
-        for axis in ("X", "Y", "Z"):
-            step = data.get_axis(axis)
-            if step != 0.0 : 
-                self.__motor_caller(axis, "move_float", 1 if step > 0.0 else -1, abs(step))
+        cdef int axis
+        for axis in range(3):
+            if event & (1 << axis):
+                if self.scheduler.motors[axis] is None:
+                    raise KeyError("XYZ"[axis])
+                self.step_position[axis] += -1 if event & (16 << axis) else 1
+        buffer.append(event, delay)
+        return(0)
+
+    cdef int __close_steps(self) except -1:
+        """
+        store steps collected so far as one command, so other commands keep their order
+        """
+        self.__collect(0)
+        if self.steps is not None and len(self.steps) > 0:
+            if self.executor is not None:
+                self.commands.append((self.executor.push, (self.steps, self.stop)))
+            else:
+                self.commands.append((self.steps.run, (self.scheduler, self.stop, self.timer)))
+            self.steps = StepBuffer()
+        return(0)
 
     def __motor_caller(self, str axis, str function, *args):
         """
         wrapper to get all method calles to external motor objects
         to implement caching, and advanced features
         """
+        self.flush()
+        if self.executor is not None:
+            self.__caller(self.executor.call, axis, function, *args)
+            return
         method_to_call = getattr(self.motors[axis], function)
         self.__caller(method_to_call, *args)
 
@@ -399,6 +685,10 @@ cdef class Controller(object):
         wrapper to get all method calles to external spindle object
         to implement caching, and advanced features
         """
+        self.flush()
+        if self.executor is not None:
+            self.__caller(self.executor.call, "spindle", function, *args)
+            return
         method_to_call = getattr(self.spindle, function)
         self.__caller(method_to_call, *args)
 
@@ -409,9 +699,9 @@ cdef class Controller(object):
         this is the point to implement autorun
 
         autorun=True version
+        commands are not stored, so memory does not grow with job size
         """
         self.gui_cb()
-        self.commands.append((method_to_call, args))
         method_to_call(*args)
 
     def __caller_norun(self, method_to_call, *args):
@@ -423,46 +713,227 @@ cdef class Controller(object):
         autrun=False version
         """
         self.gui_cb()
+        self.__close_steps()
         self.commands.append((method_to_call, args))
 
+    def consume(self, commands):
+        """
+        call Controller methods for every (method_to_call, args, methodname)
+        in commands, as they come
+
+        commands could be any iterable, like the calls list of Parser
+        or the generator Parser.iter_commands(), so parsing and
+        controller calculations are done on the fly
+        an abort before does not stop the motor commands of commands
+        """
+        self.__start()
+        for (method_to_call, args, methodname) in commands:
+            method_to_call(args)
+        self.flush()
+        self.report_unsupported()
+
+    def consume_program(self, program):
+        """
+        call Controller methods for every command in a packed Program
+
+        G00 and G01 moves are taken directly from the X/Y/Z columns,
+        without building dicts, all other commands get their args
+        like from the call list of Parser
+        """
+        cdef unsigned short[:] opcodes = program.opcodes
+        cdef unsigned int[:] masks = program.masks
+        cdef double[:] x = program.column("X")
+        cdef double[:] y = program.column("Y")
+        cdef double[:] z = program.column("Z")
+        cdef list methods = [self.get_handler(methodname) for methodname in program.names]
+        cdef list linear = [methodname in ("G0", "G00", "G1", "G01") for methodname in program.names]
+        cdef list rapid = [methodname in ("G0", "G00") for methodname in program.names]
+        cdef Py_ssize_t index
+        cdef unsigned short opcode
+        # an abort before does not stop this program
+        self.__start()
+        for index in range(opcodes.shape[0]):
+            opcode = opcodes[index]
+            if linear[opcode]:
+                self.rapid = rapid[opcode]
+                self.__linear_move_values(masks[index], x[index], y[index], z[index])
+            else:
+                methods[opcode](program.args(index))
+        self.flush()
+        self.report_unsupported()
+
+    cdef int __start(self) except -1:
+        """
+        start of a new run, clear stop event of an abort before,
+        and path mode of the run before, after its segments are planned
+        """
+        self.stop.clear()
+        if self.planner is not None:
+            self.flush()
+            self.planner.exact_stop = False
+            self.planner.junction_deviation = self.junction_deviation
+        return(0)
+
     cpdef run(self):
-        """run all commands in self.commands"""
+        """
+        run all commands in self.commands,
+        an abort before this run does not stop it
+        """
+        self.flush()
+        self.__start()
+        self.__close_steps()
         for (method_to_call, args) in self.commands:
+            if self.stop.is_set():
+                break
             logging.debug("%s(%s)", method_to_call, args)
             method_to_call(*args)
 
-    cdef __goto(self, object target):
+    cdef int __goto(self, vec3 target) except -1:
+        """
+        move to target, moves with non-linear transformers are split
+        into segments, see __subdivide
+        """
+        cdef object points
+        cdef Py_ssize_t index
+        if not self.linear:
+            points = self.__subdivide(self.current, target)
+            for index in range(1, len(points) - 1):
+                self.__goto_segment(as_vec3(points[index]))
+        self.__goto_segment(target)
+        return(0)
+
+    cdef list __subdivide(self, vec3 start, vec3 end):
+        """
+        return list of points from start to end, so that straight lines
+        between the motor positions of the points are no more than
+        kinematics_tolerance steps away from the motor positions of the
+        exact line, checked at the middle of every part
+
+        parts are halved level by level, the middle points of all parts of
+        one level are transformed in one transform_batch call,
+        so the number of transformations grows with the curvature,
+        not with the length of the move
         """
-        calculate vector between actual position and target position
-        scale this vector to motor-steps-units und split the
-        vector in unit vectors with length 1, to control single motor steps
+        cdef list points = [start.axis, end.axis]
+        cdef list motors
+        cdef list split = [True]
+        cdef list middles
+        cdef list new_points, new_motors, new_split
+        cdef PointArray transformed
+        cdef vec3 deviation
+        cdef Py_ssize_t index, part
+        cdef int depth
+        transformed = self.transformer.transform_batch(PointArray(points))
+        motors = [transformed.vec(0).axis, transformed.vec(1).axis]
+        for depth in range(MAX_SUBDIVISION_DEPTH):
+            middles = [vec3_mul(vec3_add(as_vec3(points[index]), as_vec3(points[index + 1])), 0.5).axis for index in range(len(split)) if split[index]]
+            if len(middles) == 0:
+                break
+            transformed = self.transformer.transform_batch(PointArray(middles))
+            new_points = [points[0]]
+            new_motors = [motors[0]]
+            new_split = []
+            part = 0
+            for index in range(len(split)):
+                if split[index]:
+                    deviation = vec3_sub(transformed.vec(part), vec3_mul(vec3_add(as_vec3(motors[index]), as_vec3(motors[index + 1])), 0.5))
+                    if vec3_length(deviation) * self.resolution > self.kinematics_tolerance:
+                        new_points.append(middles[part])
+                        new_motors.append(transformed.vec(part).axis)
+                        new_split.extend((True, True))
+                    else:
+                        new_split.append(False)
+                    part += 1
+                else:
+                    new_split.append(False)
+                new_points.append(points[index + 1])
+                new_motors.append(motors[index + 1])
+            points = new_points
+            motors = new_motors
+            split = new_split
+        return(points)
+
+    cdef int __goto_segment(self, vec3 target) except -1:
         """
-        cdef object move_vec_steps
-        cdef object move_vec_steps_unit
-        cdef object move_vec
-        cdef double length
+        calculate vector between actual position and target position,
+        (maybe transform it) and scale this vector to motor-steps-units
+
+        the exact position in steps is accumulated in self.step_target,
+        every motor is moved to the nearest whole step with an integer DDA
+        (bresenham), the axis with the most steps is stepped every tick,
+        the others if their error term reaches half a tick.
+        so motors are never more than half a step away from the
+        exact position, without drift of floating point operations
+
+        if the segment planner is available, only the target in steps
+        and feed rate is collected, and steps are calculated for many segments at once
+        """
+        cdef vec3 move_vec
+        cdef Point3d transformed
+        cdef long counts[3]
+        cdef long errors[3]
+        cdef int directions[3]
+        cdef long delta, ticks, tick
+        cdef double length, speed
+        cdef int axis
+        cdef unsigned char event
+        cdef double delay
+        cdef object buffer
+        # vector from position to target in mm
+        move_vec = vec3_sub(target, self.current)
         # nothing to move?
-        if target == self.position:
+        if vec3_is_zero(move_vec):
             return(0)
-        else:
-            # vector from position to target in mm
-            move_vec = target - self.position
+        length = vec3_length(move_vec)
         # maybe some tranformation and scaling ?
-        move_vec = self.transformer.transform(move_vec)
-        # scale from mm to steps unit 
-        move_vec_steps = move_vec * self.resolution
-        # and not get the unit vector, length=1
-        move_vec_steps_unit = move_vec_steps.unit()
-        # use while loop the get to the exact value
-        length = move_vec_steps.length()
-        while length > 1.0:
-            self.__motor_steps(move_vec_steps_unit)
-            length -= 1
-            move_vec_steps = move_vec_steps - move_vec_steps_unit
-        # the last fraction left
-        self.__motor_steps(move_vec_steps)
+        if self.transformer.absolute:
+            # scale from mm to steps unit, without drift
+            transformed = self.transformer.transform_position(vec3_point(target))
+            self.step_target[0] = transformed.X * self.resolution
+            self.step_target[1] = transformed.Y * self.resolution
+            self.step_target[2] = transformed.Z * self.resolution
+        else:
+            transformed = self.transformer.transform(vec3_point(move_vec))
+            # scale from mm to steps unit
+            self.step_target[0] += transformed.X * self.resolution
+            self.step_target[1] += transformed.Y * self.resolution
+            self.step_target[2] += transformed.Z * self.resolution
+        if self.planner is not None:
+            for axis in range(3):
+                self.step_position[axis] = lround(self.step_target[axis])
+            # feed rate in units per second, G00 as fast as possible
+            speed = 0.0 if self.rapid else self.feed / 60.0
+            if self.planner.add(self.step_position[0], self.step_position[1], self.step_position[2], length, speed):
+                # motors keep moving, only at flush the planner stops at rest
+                self.__plan(False)
+            self.current = target
+            return(0)
+        ticks = 0
+        for axis in range(3):
+            delta = lround(self.step_target[axis]) - self.step_position[axis]
+            directions[axis] = 1 if delta > 0 else -1
+            counts[axis] = labs(delta)
+            errors[axis] = 0
+            if counts[axis] > ticks:
+                ticks = counts[axis]
+        # steps of segment are collected and executed at once if autorun
+        delay = self.__tick_delay()
+        buffer = self.steps if self.steps is not None else StepBuffer()
+        for tick in range(ticks):
+            event = 0
+            for axis in range(3):
+                errors[axis] += counts[axis]
+                if 2 * errors[axis] >= ticks:
+                    errors[axis] -= ticks
+                    event |= (1 << axis) if directions[axis] > 0 else (17 << axis)
+            self.__motor_tick(buffer, event, delay)
+        if self.steps is not None:
+            self.gui_cb()
+        elif ticks > 0:
+            self.__caller(buffer.run, self.scheduler, self.stop, self.timer)
         # set own position to target, done
-        self.position = target
+        self.current = target
+        return(0)
 
     cdef set_speed(self, dict data):
         """
@@ -483,12 +954,11 @@ cdef class Controller(object):
         so to move in both direction at the same time,
         parameter x or y has to be sometime float
         """
-        cdef object target = Point3d(0, 0, 0)
-        for axis in ("X", "Y", "Z"):
-            if axis in data:
-                target.set_axis(axis, self.position.get_axis(axis) + data[axis])
-            else:
-                target.set_axis(axis, self.position.get_axis(axis))
+        cdef vec3 target = self.current
+        cdef int axis
+        for axis in range(3):
+            if "XYZ"[axis] in data:
+                target.axis[axis] += data["XYZ"[axis]]
         self.__goto(target)
 
     def __linear_move_abs(self, data):
@@ -498,18 +968,23 @@ cdef class Controller(object):
         it is not necessary to give alle three axis, when no value is
         present, there is not movement on this axis
         """
-        target = Point3d(0.0, 0.0, 0.0)
-        for axis in ("X", "Y", "Z"):
-            if axis in data:
-                target.set_axis(axis, data[axis])
-            else:
-                target.set_axis(axis, self.position.get_axis(axis))
+        cdef vec3 target = self.current
+        cdef int axis
+        for axis in range(3):
+            if "XYZ"[axis] in data:
+                target.axis[axis] = data["XYZ"[axis]]
         self.__goto(target)
 
-    def __getattr__(self, name):
-        """handle unknwon methods"""
-        def method(*args):
-            logging.info("tried to handle unknown method " + name)
-            if args:
-                logging.info("it had arguments: " + str(args))
-        return method
+    cdef __linear_move_values(self, unsigned int mask, double x, double y, double z):
+        """
+        linear movement like __linear_move_abs and __linear_move_inc,
+        but without dict, bit 23/24/25 of mask indicate if X/Y/Z are given
+        """
+        cdef vec3 target = self.current
+        if mask & (1 << 23):
+            target.axis[0] = target.axis[0] + x if self.incremental else x
+        if mask & (1 << 24):
+            target.axis[1] = target.axis[1] + y if self.incremental else y
+        if mask & (1 << 25):
+            target.axis[2] = target.axis[2] + z if self.incremental else z
+        self.__goto(target)
@@ -10,12 +10,209 @@ Motor Classes for Controller
 
 import logging
 logging.basicConfig(level=logging.INFO, format="%(message)s")
-import time
+cimport cython
+from posix.time cimport clock_gettime, nanosleep, timespec, CLOCK_MONOTONIC
+from posix.fcntl cimport open as c_open, O_WRONLY
+from posix.unistd cimport write as c_write, close as c_close
+import os
+
+# number of bins in jitter histogram, last bin counts all later ticks
+cdef enum:
+    HISTOGRAM_BINS = 64
+
+# pins of pin_write_t, and bits of event like in StepBuffer
+cdef enum:
+    PIN_STEP = 0
+    PIN_DIR = 1
+    STEP_X = 1
+    REVERSE_X = 16
+
+# maximum number of ticks and their summed delays in nanoseconds
+# without GIL, before stop is checked
+cdef enum:
+    CHUNK_TICKS = 256
+    CHUNK_NS = 10000000
+
+# C level write of value 0 or 1 to step or dir pin of motor, called without GIL
+ctypedef void (*pin_write_t)(void *context, int pin, int value) noexcept nogil
+
+# state of one axis in execute_steps
+cdef struct axis_t:
+    pin_write_t pin_write
+    void *context
+    int position
+    int min_position
+    int max_position
+    int sos_exception
+    int direction
+    unsigned long skipped
+    long long pulse_ns
+
+
+@cython.profile(False)
+cdef inline long long monotonic_ns() noexcept nogil:
+    """return monotonic clock in nanoseconds"""
+    cdef timespec now
+    clock_gettime(CLOCK_MONOTONIC, &now)
+    return(now.tv_sec * 1000000000LL + now.tv_nsec)
+
+
+@cython.profile(False)
+@cython.cdivision(True)
+cdef inline void sleep_until(long long deadline, long long spin) noexcept nogil:
+    """
+    sleep coarsely until spin nanoseconds before deadline,
+    and spin for the rest, sleeping alone oversleeps too much on Linux
+    """
+    cdef timespec duration
+    cdef long long time_gap = deadline - spin - monotonic_ns()
+    if time_gap > 0:
+        duration.tv_sec = time_gap // 1000000000LL
+        duration.tv_nsec = time_gap % 1000000000LL
+        nanosleep(&duration, NULL)
+    while monotonic_ns() < deadline:
+        pass
+
+
+@cython.profile(False)
+cdef void write_file(void *context, int pin, int value) noexcept nogil:
+    """pin_write_t for files like /sys/class/gpio/gpio17/value, context are the file descriptors"""
+    c_write((<int *>context)[pin], b"1" if value else b"0", 1)
+
+
+cdef class StepTimer(object):
+    """
+    Class to wait for ticks on a timeline of absolute deadlines
+
+    every deadline is the previous deadline plus the interval, so a
+    little late tick shortens the wait for the next one, and errors do
+    not add up. waiting is a coarse sleep and a spin over the last spin seconds
+
+    if a tick is more than half its interval or resync seconds late,
+    the timeline starts again from now, and the tick is counted in resyncs,
+    so ticks are never closer than half their interval, and missed
+    deadlines are not caught up with a burst of ticks
+
+    lateness of every tick, late ones too, is counted in a histogram
+    of bins with bin_width seconds
+    """
+
+    cdef long long deadline
+    cdef long long spin_ns
+    cdef long long resync_ns
+    cdef long long bin_width_ns
+    cdef unsigned long bins[HISTOGRAM_BINS]
+    cdef unsigned long ticks
+    cdef unsigned long resyncs
+    cdef long long lateness_max
+    cdef long long lateness_sum
+
+    def __init__(self, double spin=0.0002, double resync=0.1, double bin_width=0.00001):
+        """
+        @params
+        spin -> seconds before deadline to stop sleeping and start spinning
+        resync -> seconds of lateness, after which the timeline starts again,
+            also if lateness is more than half the interval
+        bin_width -> width of one bin of jitter histogram in seconds
+        """
+        self.spin_ns = <long long>(spin * 1e9)
+        self.resync_ns = <long long>(resync * 1e9)
+        self.bin_width_ns = max(<long long>(bin_width * 1e9), 1)
+        self.reset()
+        self.start()
+
+    cpdef int start(self):
+        """start timeline now, the next deadline is one interval from now"""
+        self.deadline = monotonic_ns()
+        return(0)
+
+    cpdef int reset(self):
+        """clear jitter histogram and counters"""
+        cdef int index
+        for index in range(HISTOGRAM_BINS):
+            self.bins[index] = 0
+        self.ticks = 0
+        self.resyncs = 0
+        self.lateness_max = 0
+        self.lateness_sum = 0
+        return(0)
+
+    @cython.profile(False)
+    @cython.cdivision(True)
+    cdef long long wait_ns(self, long long interval) noexcept nogil:
+        """
+        wait until next deadline, interval nanoseconds after the last one,
+        returns lateness in nanoseconds
+        """
+        cdef long long lateness
+        self.deadline += interval
+        sleep_until(self.deadline, self.spin_ns)
+        lateness = monotonic_ns() - self.deadline
+        if lateness > self.resync_ns or 2 * lateness > interval:
+            # do not catch up with a burst of ticks,
+            # the next tick is a whole interval after this one
+            self.deadline += lateness
+            self.resyncs += 1
+        self.bins[min(lateness // self.bin_width_ns, HISTOGRAM_BINS - 1)] += 1
+        self.ticks += 1
+        self.lateness_sum += lateness
+        if lateness > self.lateness_max:
+            self.lateness_max = lateness
+        return(lateness)
+
+    cpdef double wait(self, double interval):
+        """
+        wait until next deadline, interval seconds after the last one,
+        returns lateness in seconds
+        """
+        cdef long long lateness
+        cdef long long interval_ns = <long long>(interval * 1e9)
+        with nogil:
+            lateness = self.wait_ns(interval_ns)
+        return(lateness / 1e9)
+
+    cpdef int pause(self, double duration):
+        """
+        wait duration seconds from now, like time.sleep but precise,
+        does not move the timeline
+        """
+        cdef long long deadline = monotonic_ns() + <long long>(duration * 1e9)
+        with nogil:
+            sleep_until(deadline, self.spin_ns)
+        return(0)
+
+    def histogram(self):
+        """
+        return list of (lateness in seconds, number of ticks),
+        lateness is the start of the bin, the last bin counts all later ticks
+        """
+        return([(index * self.bin_width_ns / 1e9, self.bins[index]) for index in range(HISTOGRAM_BINS)])
+
+    def stats(self):
+        """
+        return counters of timer
+        ticks -> number of ticks in histogram
+        resyncs -> how often the timeline was started again
+        jitter_max, jitter_mean -> lateness of ticks in seconds
+        """
+        return({
+            "ticks" : self.ticks,
+            "resyncs" : self.resyncs,
+            "jitter_max" : self.lateness_max / 1e9,
+            "jitter_mean" : self.lateness_sum / 1e9 / self.ticks if self.ticks > 0 else 0.0,
+        })
+
 
 cdef class BaseMotor(object):
     """
     Base - Class for Motors
-    usually you have to overwrite __move and unhold methods
+    usually you have to overwrite _move and unhold methods
+
+    to share one pulse window with other motors in StepScheduler,
+    overwrite _pulse_start and _pulse_end and set pulse_width
+
+    with set_pin_files step and dir pin are written in C, and
+    execute_plan runs without python, python hooks are not called then
     """
 
     cdef public tuple SEQUENCE_LOW
@@ -28,7 +225,10 @@ cdef class BaseMotor(object):
     cdef int sos_exception
     cdef public int position
     cdef double float_position
-    cdef double last_step_time
+    cdef public StepTimer timer
+    cdef public double pulse_width
+    cdef pin_write_t pin_write
+    cdef int pin_files[2]
 
     def __init__(self, int max_position, int min_position, double delay, int sos_exception):
         """
@@ -46,8 +246,14 @@ cdef class BaseMotor(object):
         # define float and integer position
         self.position = 0
         self.float_position = 0.0
-        # timekeeping
-        self.last_step_time = time.time()
+        # timekeeping, every step is delay seconds after the last one
+        self.timer = StepTimer()
+        # time between _pulse_start and _pulse_end
+        self.pulse_width = 0.0
+        # no C level pin write, see set_pin_files
+        self.pin_write = NULL
+        self.pin_files[PIN_STEP] = -1
+        self.pin_files[PIN_DIR] = -1
         # low torque mode - also low power as only one coil is powered
         self.SEQUENCE_LOW = ((1, 0, 0, 0), (0, 0, 1, 0), (0, 1, 0, 0), (0, 0, 0, 1))
         # high torque - full step mode
@@ -68,7 +274,6 @@ cdef class BaseMotor(object):
             internally a step is only initialized if a full step is reached
         """
         cdef double temp
-        cdef double time_gap
         cdef double distance
         #logging.debug("move_float called with %d, %f", direction, float_step)
         # boundary check
@@ -80,10 +285,8 @@ cdef class BaseMotor(object):
                 logging.error("%s < %s < %s not true", self.min_position, temp, self.max_position)
                 # dont move any further
                 return(0)
-        # next step should not before self.last_step_time + self.delay
-        time_gap = self.last_step_time + self.delay - time.time()
-        if time_gap > 0:
-            time.sleep(time_gap)
+        # next step should not before deadline of last step + self.delay
+        self.timer.wait(self.delay)
         # boundary check ok, waited for stepper interleave, lets rock
         self.float_position = temp
         distance = abs(self.position - self.float_position)
@@ -91,11 +294,65 @@ cdef class BaseMotor(object):
         # distance should never be more than 2
         if distance >= 1.0:
             self._move(direction)
-        # remember last_step_time
-        self.last_step_time = time.time()
         return(0)
 
-    cdef int _move(self, int direction):
+    cpdef int step(self, int direction):
+        """
+        this method is called to move exactly one step, waits for delay
+        @param
+        direction -> inidcates which direction stepper should move, 1 or -1
+        """
+        # next step should not before deadline of last step + self.delay
+        self.timer.wait(self.delay)
+        if self.pulse_start(direction):
+            if self.pulse_width > 0.0:
+                self.timer.pause(self.pulse_width)
+            self.pulse_end()
+        return(0)
+
+    cpdef int pulse_start(self, int direction):
+        """
+        this method is called from StepScheduler to start one step,
+        returns False if the step is outside of the boundary
+        @param
+        direction -> inidcates which direction stepper should move, 1 or -1
+        """
+        cdef int temp
+        # boundary check
+        temp = self.position + direction
+        if not (self.min_position <= temp <= self.max_position):
+            if self.sos_exception != 0:
+                raise(StandardError("Boundary reached: %s < %s < %s not true" % (self.min_position, temp, self.max_position)))
+            else:
+                logging.error("%s < %s < %s not true", self.min_position, temp, self.max_position)
+                # dont move any further
+                return(False)
+        self._pulse_start(direction)
+        self.float_position = self.position
+        return(True)
+
+    cpdef int pulse_end(self):
+        """
+        this method is called from StepScheduler to end the step started
+        with pulse_start, after pulse_width seconds
+        """
+        self._pulse_end()
+        return(0)
+
+    cpdef _pulse_start(self, int direction):
+        """
+        start of step, defaults to the whole step
+        """
+        self._move(direction)
+        return(0)
+
+    cpdef _pulse_end(self):
+        """
+        end of step, nothing to do if _pulse_start does the whole step
+        """
+        return(0)
+
+    cpdef _move(self, int direction):
         """
         move number of full integer steps
         """
@@ -106,6 +363,51 @@ cdef class BaseMotor(object):
         """release power"""
         return(0)
 
+    def set_pin_files(self, str step_path, str dir_path):
+        """
+        write step and dir pin in execute_plan without python,
+        to files like /sys/class/gpio/gpio17/value of exported pins
+        @params
+        step_path -> file of step pin, pulse LOW - HIGH - LOW
+        dir_path -> file of dir pin, HIGH in direction 1
+        """
+        self.close_pin_files()
+        for pin, path in ((PIN_STEP, step_path), (PIN_DIR, dir_path)):
+            self.pin_files[pin] = c_open(path.encode(), O_WRONLY)
+            if self.pin_files[pin] < 0:
+                self.close_pin_files()
+                raise IOError("could not open pin file %s" % path)
+        self.pin_write = write_file
+
+    def close_pin_files(self):
+        """close files of set_pin_files, steps are done with python again"""
+        cdef int pin
+        self.pin_write = NULL
+        for pin in (PIN_STEP, PIN_DIR):
+            if self.pin_files[pin] >= 0:
+                c_close(self.pin_files[pin])
+                self.pin_files[pin] = -1
+
+    cpdef int is_native(self):
+        """
+        True if steps of this motor can be done without python,
+        with C level pin write, or no pins at all in BaseMotor itself
+        """
+        return(self.pin_write != NULL or type(self) is BaseMotor)
+
+    def execute_plan(self, object buffer, int axis=0, object stop=None, StepTimer timer=None):
+        """
+        execute all steps of axis 0, 1, 2 for X, Y, Z in StepBuffer buffer
+        with GIL released, see execute_steps
+        """
+        motors = [None, None, None]
+        motors[axis] = self
+        return(execute_steps(motors, buffer, stop, timer, True))
+
+    cpdef double get_delay(self):
+        """return minimal delay between two steps in seconds"""
+        return(self.delay)
+
     cpdef int get_position(self):
         """return real position as int"""
         return(self.position)
@@ -114,3 +416,135 @@ cdef class BaseMotor(object):
         """return exact position as float"""
         return(self.float_position)
 
+
+
+@cython.profile(False)
+cdef unsigned int execute_run(axis_t *axes, unsigned char event, unsigned int count, long long delay, StepTimer timer) noexcept nogil:
+    """
+    execute count ticks of event delay nanoseconds apart, all steps of a
+    tick share one pulse window, returns number of ticks done, less than
+    count if a motor with sos_exception would leave its boundary
+    """
+    cdef unsigned int tick
+    cdef int axis
+    cdef int directions[3]
+    cdef long long pulse_ns = 0
+    for axis in range(3):
+        directions[axis] = 0
+        if event & (STEP_X << axis):
+            directions[axis] = -1 if event & (REVERSE_X << axis) else 1
+            if axes[axis].pulse_ns > pulse_ns:
+                pulse_ns = axes[axis].pulse_ns
+    for tick in range(count):
+        for axis in range(3):
+            if directions[axis] != 0 and axes[axis].sos_exception and not (axes[axis].min_position <= axes[axis].position + directions[axis] <= axes[axis].max_position):
+                return(tick)
+        timer.wait_ns(delay)
+        for axis in range(3):
+            if directions[axis] == 0:
+                continue
+            if not (axes[axis].min_position <= axes[axis].position + directions[axis] <= axes[axis].max_position):
+                # dont move any further
+                axes[axis].skipped += 1
+                continue
+            if axes[axis].pin_write != NULL:
+                if directions[axis] != axes[axis].direction:
+                    axes[axis].pin_write(axes[axis].context, PIN_DIR, directions[axis] == 1)
+                    axes[axis].direction = directions[axis]
+                axes[axis].pin_write(axes[axis].context, PIN_STEP, 1)
+            axes[axis].position += directions[axis]
+        if pulse_ns > 0:
+            sleep_until(monotonic_ns() + pulse_ns, timer.spin_ns)
+        for axis in range(3):
+            if directions[axis] != 0 and axes[axis].pin_write != NULL:
+                axes[axis].pin_write(axes[axis].context, PIN_STEP, 0)
+    return(count)
+
+
+def execute_steps(list motors, object buffer, object stop=None, StepTimer timer=None, int ignore_missing=False):
+    """
+    execute all steps of StepBuffer buffer with motors of X, Y, Z,
+    like StepScheduler, but in a C loop with GIL released,
+    all motors must be native, see BaseMotor.is_native
+
+    steps of axes with motor None raise KeyError like in StepScheduler,
+    or are left out if ignore_missing, ticks keep their delay
+
+    stop is checked every CHUNK_TICKS ticks, or earlier after 10ms of
+    delays, boundary errors are raised or logged like in BaseMotor.pulse_start
+    """
+    cdef axis_t axes[3]
+    cdef BaseMotor motor
+    cdef const unsigned char[:] events = buffer.events
+    cdef const unsigned int[:] counts = buffer.counts
+    cdef const float[:] delays = buffer.delays
+    cdef Py_ssize_t index
+    cdef unsigned int done, todo, chunk
+    cdef unsigned char event
+    cdef unsigned char mask = 0xff
+    cdef long long delay
+    cdef int axis
+    if timer is None:
+        timer = StepTimer()
+    for axis in range(3):
+        axes[axis].pin_write = NULL
+        axes[axis].direction = 0
+        axes[axis].skipped = 0
+        axes[axis].pulse_ns = 0
+        motor = motors[axis]
+        if motor is None and ignore_missing:
+            mask &= ~((STEP_X | REVERSE_X) << axis)
+            continue
+        if motor is None:
+            # every step raises KeyError
+            axes[axis].position = 0
+            axes[axis].min_position = 1
+            axes[axis].max_position = -1
+            axes[axis].sos_exception = True
+            continue
+        if not motor.is_native():
+            raise TypeError("motor of axis %s is not native" % "XYZ"[axis])
+        axes[axis].pin_write = motor.pin_write
+        axes[axis].context = motor.pin_files
+        axes[axis].position = motor.position
+        axes[axis].min_position = motor.min_position
+        axes[axis].max_position = motor.max_position
+        axes[axis].sos_exception = motor.sos_exception != 0
+        axes[axis].pulse_ns = <long long>(motor.pulse_width * 1e9)
+    timer.start()
+    try:
+        for index in range(events.shape[0]):
+            event = events[index] & mask
+            delay = <long long>(delays[index] * 1e9)
+            todo = counts[index]
+            while todo > 0:
+                if stop is not None and stop.is_set():
+                    return(0)
+                chunk = min(todo, CHUNK_TICKS)
+                if delay > 0:
+                    chunk = min(chunk, <unsigned int>max(CHUNK_NS // delay, 1))
+                with nogil:
+                    done = execute_run(axes, event, chunk, delay, timer)
+                todo -= done
+                for axis in range(3):
+                    if axes[axis].skipped > 0:
+                        logging.error("%s steps of axis %s outside of %s and %s skipped", axes[axis].skipped, "XYZ"[axis], axes[axis].min_position, axes[axis].max_position)
+                        axes[axis].skipped = 0
+                if done < chunk:
+                    for axis in range(3):
+                        if event & (STEP_X << axis) and not (axes[axis].min_position <= axes[axis].position + (-1 if event & (REVERSE_X << axis) else 1) <= axes[axis].max_position):
+                            if motors[axis] is None:
+                                raise KeyError("XYZ"[axis])
+                            motor = motors[axis]
+                            motor.position = axes[axis].position
+                            # raises like a single step
+                            motor.pulse_start(-1 if event & (REVERSE_X << axis) else 1)
+                    # dont move any further in this run
+                    break
+    finally:
+        for axis in range(3):
+            if motors[axis] is not None:
+                motor = motors[axis]
+                motor.position = axes[axis].position
+                motor.float_position = axes[axis].position
+    return(0)
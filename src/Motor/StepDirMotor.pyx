@@ -34,6 +34,8 @@ class StepDirMotor(BaseMotor.BaseMotor):
         self.enable_pin = enable_pin
         self.step_pin = step_pin
         self.dir_pin = dir_pin
+        # duty cycle of 1ms to hold high level of pulse
+        self.pulse_width = 0.001
         # power on
         self.enable()
 
@@ -41,6 +43,14 @@ class StepDirMotor(BaseMotor.BaseMotor):
         """
         move one step in direction
         """
+        self._pulse_start(direction)
+        time.sleep(self.pulse_width)
+        self._pulse_end()
+
+    def _pulse_start(self, int direction):
+        """
+        set direction and start pulse of one step
+        """
         self.position += direction
         # direction is either -1 or 1
         if direction == 1:
@@ -49,8 +59,11 @@ class StepDirMotor(BaseMotor.BaseMotor):
             self.dir_pin.output(0)
         # driver triggers LOW - HIGH impulse
         self.step_pin.output(1)
-        # duty cycle of 1ms to hold high level of pulse
-        time.sleep(0.001)
+
+    def _pulse_end(self):
+        """
+        end pulse of step
+        """
         self.step_pin.output(0)
 
     def unhold(self):
@@ -0,0 +1,71 @@
+#/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# parse Gcode
+#
+"""
+Step Scheduler for Motors
+"""
+
+# own modules
+from BaseMotor import StepTimer as StepTimer
+
+
+cdef class StepScheduler(object):
+    """
+    Class to emit the steps of X, Y and Z motor of one tick together
+
+    ticks are given as event, bit 0, 1, 2 for a step of X, Y, Z
+    and bit 4, 5, 6 if this step is in negative direction
+
+    all motors of one tick start their pulse, wait one shared pulse window
+    and end their pulse, so a diagonal step takes as long as a single one.
+    timing between ticks is done by the caller, on one timeline for all
+    axes, motors do not sleep on their own
+    """
+
+    cdef public list motors
+    cdef object timer
+
+    def __init__(self):
+        self.motors = [None, None, None]
+        # precise pulse window, time.sleep oversleeps
+        self.timer = StepTimer()
+
+    cpdef int set_motor(self, int axis, object motor):
+        """set motor of axis 0, 1, 2 for X, Y, Z"""
+        self.motors[axis] = motor
+        return(0)
+
+    cpdef int is_native(self):
+        """
+        True if all motors can do their steps without python,
+        so runs of steps can be executed with execute_steps
+        """
+        for motor in self.motors:
+            if motor is not None and not motor.is_native():
+                return(False)
+        return(True)
+
+    cpdef int tick(self, unsigned char event) except -1:
+        """
+        do all steps of event at once
+        """
+        cdef int axis
+        cdef int started[3]
+        cdef double pulse_width = 0.0
+        for axis in range(3):
+            started[axis] = False
+            if event & (1 << axis):
+                motor = self.motors[axis]
+                if motor is None:
+                    raise KeyError("XYZ"[axis])
+                started[axis] = motor.pulse_start(-1 if event & (16 << axis) else 1)
+                if started[axis] and motor.pulse_width > pulse_width:
+                    pulse_width = motor.pulse_width
+        if pulse_width > 0.0:
+            self.timer.pause(pulse_width)
+        for axis in range(3):
+            if started[axis]:
+                self.motors[axis].pulse_end()
+        return(0)
@@ -7,9 +7,325 @@
 Module to parse Gcode from File
 """
 import os
+import gc
+import mmap
+import array
+import multiprocessing
 import logging
 logging.basicConfig(level=logging.DEBUG, format="%(message)s")
-import re
+
+# change if parsing results change, invalidates cached programs
+PARSER_VERSION = 1
+# in parallel parsing, the last G Code of a chunk is not known
+# until the first G Code in this chunk
+UNKNOWN_G_CODE = "?"
+
+from libc.stdlib cimport strtod
+from libc.string cimport memcpy, memchr, memset
+from cpython.ref cimport PyObject
+from cpython.buffer cimport PyObject_GetBuffer, PyBuffer_Release, PyBUF_SIMPLE
+from cpython cimport array
+
+# maximum number of F/S/T or G/M words stored for one line
+cdef enum:
+    MAX_WORDS = 16
+    MAX_NUMBER = 64
+    # size of the word cache, must be 256, the slot is the upper byte of the hash
+    WORD_SLOTS = 256
+    # bit in Program masks, parameters are the same object as in the previous command
+    SAME_PARAMS = 1 << 31
+
+# word classification by letter
+cdef enum:
+    WORD_NONE = 0
+    WORD_PARAM = 1 # X, Y, Z, I, J, K, P, R, U, V, W, A, B, C
+    WORD_CODE = 2 # F, S, T
+    WORD_GCODE = 3 # G, M
+
+cdef int WORD_KINDS[26]
+cdef int _index
+for _index in range(26):
+    WORD_KINDS[_index] = WORD_NONE
+for _letter in "XYZIJKPRUVWABC":
+    WORD_KINDS[ord(_letter) - 65] = WORD_PARAM
+for _letter in "FST":
+    WORD_KINDS[ord(_letter) - 65] = WORD_CODE
+for _letter in "GM":
+    WORD_KINDS[ord(_letter) - 65] = WORD_GCODE
+# parameter names, indexed by letter
+cdef tuple LETTERS = tuple(chr(65 + _index) for _index in range(26))
+
+
+cdef inline double parse_number(const char *buf, Py_ssize_t start, Py_ssize_t end) except? -1:
+    """
+    convert characters buf[start:end] to double, same result as float()
+    """
+    cdef char number[MAX_NUMBER]
+    cdef char *stop
+    cdef Py_ssize_t length = end - start
+    cdef double value
+    if length >= MAX_NUMBER:
+        return(float(buf[start:end]))
+    memcpy(number, buf + start, length)
+    number[length] = 0
+    value = strtod(number, &stop)
+    if stop != number + length:
+        raise ValueError("could not convert string to float: %r" % buf[start:end])
+    return(value)
+
+
+cdef class Program(object):
+    """
+    Packed representation of a parsed G-Code Program, struct of arrays
+
+    opcodes -> array of unsigned short, index of methodname in names
+    masks -> array of unsigned int, bit n is set if letter chr(65 + n) is given
+    columns -> one array of doubles per used parameter letter, with one value
+        per command, 0.0 if not given
+    code_values -> the values of the rare F, S and T Codes, by command index
+
+    compared to the call list of Parser no dict, float, tuple or bound
+    method is allocated per command
+    """
+
+    cdef public list names
+    cdef dict opcode_of
+    cdef public array.array opcodes
+    cdef public array.array masks
+    cdef dict columns
+    cdef public dict code_values
+    cdef list column_list
+    cdef int column_index[26]
+    cdef Py_ssize_t length
+    cdef Py_ssize_t capacity
+    cdef Py_ssize_t last_index
+    cdef object last_args
+    cdef object last_name
+    cdef unsigned short last_opcode
+
+    def __init__(self):
+        self.names = []
+        self.opcode_of = {}
+        self.opcodes = array.array("H")
+        self.masks = array.array("I")
+        self.columns = {}
+        self.code_values = {}
+        self.column_list = []
+        for index in range(26):
+            self.column_index[index] = -1
+        self.length = 0
+        self.capacity = 0
+        self.last_index = -1
+        self.last_args = None
+        # opcode of the previous command, most commands repeat it
+        self.last_name = None
+        self.last_opcode = 0
+
+    def __len__(self):
+        return(self.length)
+
+    cdef int add_column(self, int letter) except -1:
+        """
+        add column for letter chr(65 + letter), filled with 0.0 for existing commands
+        """
+        cdef array.array column = array.array("d", [0.0]) * self.capacity
+        self.column_index[letter] = len(self.column_list)
+        self.column_list.append(column)
+        self.columns[LETTERS[letter]] = column
+        return(0)
+
+    cdef int reserve(self, Py_ssize_t size) except -1:
+        """
+        grow capacity of all arrays to at least size commands, by doubling,
+        new column entries are 0.0
+        """
+        cdef array.array column
+        cdef Py_ssize_t capacity = max(self.capacity, 1024)
+        if size <= self.capacity:
+            return(0)
+        while capacity < size:
+            capacity *= 2
+        array.resize(self.opcodes, capacity)
+        array.resize(self.masks, capacity)
+        for column in self.column_list:
+            array.resize(column, capacity)
+            memset(column.data.as_doubles + self.capacity, 0, (capacity - self.capacity) * sizeof(double))
+        self.capacity = capacity
+        return(0)
+
+    cdef int opcode(self, str methodname) except -1:
+        """
+        return opcode of methodname, methodname is added to names if new
+        """
+        if methodname is not self.last_name:
+            try:
+                self.last_opcode = self.opcode_of[methodname]
+            except KeyError:
+                self.last_opcode = len(self.names)
+                self.opcode_of[methodname] = self.last_opcode
+                self.names.append(methodname)
+            self.last_name = methodname
+        return(self.last_opcode)
+
+    cdef int append_code(self, str methodname, double value) except -1:
+        """
+        append F, S or T Code with its value
+        """
+        self.code_values[self.length] = value
+        return(self.append(methodname, NULL, 0))
+
+    cdef int append(self, str methodname, double *values, unsigned int mask) except -1:
+        """
+        append one command, values[n] is used if bit n of mask is set
+        """
+        cdef array.array column
+        cdef int letter
+        cdef unsigned int letters = mask & ~SAME_PARAMS
+        cdef unsigned short opcode = self.opcode(methodname)
+        if self.length == self.capacity:
+            self.reserve(self.length + 1)
+        self.opcodes.data.as_ushorts[self.length] = opcode
+        self.masks.data.as_uints[self.length] = mask
+        for letter in range(26):
+            if letters & (1 << letter):
+                if self.column_index[letter] == -1:
+                    self.add_column(letter)
+                column = self.column_list[self.column_index[letter]]
+                column.data.as_doubles[self.length] = values[letter]
+        self.length += 1
+        return(0)
+
+    cdef int trim(self) except -1:
+        """release memory preallocated while appending"""
+        array.resize(self.opcodes, self.length)
+        array.resize(self.masks, self.length)
+        for column in self.column_list:
+            array.resize(column, self.length)
+        self.capacity = self.length
+        return(0)
+
+    cpdef int extend(self, Program other, str last_g_code) except -1:
+        """
+        append all commands of other in bulk, arrays are copied,
+        no dicts are built
+
+        @params
+        other -> Program to append, for example parsed from a later part of the file
+        last_g_code -> methodname for commands of other with methodname
+            UNKNOWN_G_CODE, the last G Code before other
+        """
+        cdef array.array remap = array.array("H")
+        cdef array.array column
+        cdef unsigned short *opcodes
+        cdef Py_ssize_t index
+        cdef int letter
+        for methodname in other.names:
+            remap.append(self.opcode(last_g_code if methodname == UNKNOWN_G_CODE else methodname))
+        self.reserve(self.length + other.length)
+        opcodes = self.opcodes.data.as_ushorts + self.length
+        for index in range(other.length):
+            opcodes[index] = remap.data.as_ushorts[other.opcodes.data.as_ushorts[index]]
+        memcpy(self.masks.data.as_uints + self.length, other.masks.data.as_uints, other.length * sizeof(unsigned int))
+        for letter in range(26):
+            if other.column_index[letter] == -1:
+                continue
+            if self.column_index[letter] == -1:
+                self.add_column(letter)
+            column = self.column_list[self.column_index[letter]]
+            memcpy(column.data.as_doubles + self.length, (<array.array>other.column_list[other.column_index[letter]]).data.as_doubles, other.length * sizeof(double))
+        for index, value in other.code_values.items():
+            self.code_values[self.length + index] = value
+        self.length += other.length
+        return(0)
+
+    cpdef tuple parts(self):
+        """
+        return (names, opcodes, masks, columns, code_values),
+        columns is a dict of arrays by letter
+
+        unpack_program(*parts) builds the same Program again
+        """
+        self.trim()
+        return((self.names, self.opcodes, self.masks, self.columns, self.code_values))
+
+    def __reduce__(self):
+        """Programs are pickled as their arrays, for example from worker processes"""
+        return((unpack_program, self.parts()))
+
+    cpdef array.array column(self, str letter):
+        """
+        return values of letter for all commands, check masks if it is given
+        """
+        if letter in self.columns:
+            return(self.columns[letter])
+        return(array.array("d", [0.0]) * self.length)
+
+    cpdef object args(self, Py_ssize_t index):
+        """
+        return args of command index like in the call list of Parser,
+        a dict of parameters for G and M Codes, the value for F, S and T Codes
+
+        consecutive commands of the same line get the same dict
+        """
+        cdef str methodname = self.names[self.opcodes[index]]
+        cdef unsigned int mask = self.masks[index]
+        cdef dict params
+        cdef int letter
+        if index in self.code_values:
+            return(self.code_values[index])
+        if mask & SAME_PARAMS and index - 1 == self.last_index:
+            self.last_index = index
+            return(self.last_args)
+        params = {}
+        for letter in range(26):
+            if mask & (1 << letter):
+                params[LETTERS[letter]] = self.column_list[self.column_index[letter]][index]
+        self.last_index = index
+        self.last_args = params
+        return(params)
+
+    cpdef long nbytes(self):
+        """return memory used by the arrays in bytes"""
+        cdef long size = self.opcodes.itemsize * len(self.opcodes) + self.masks.itemsize * len(self.masks)
+        for column in self.column_list:
+            size += column.itemsize * len(column)
+        return(size)
+
+
+cpdef Program unpack_program(list names, array.array opcodes, array.array masks, dict columns, dict code_values):
+    """
+    return Program from the arrays of Program.parts()
+    raises ValueError if the arrays do not fit together
+    """
+    cdef Program program = Program()
+    cdef Py_ssize_t length = len(opcodes)
+    cdef Py_ssize_t index
+    cdef unsigned int seen = 0
+    cdef int letter
+    if opcodes.typecode != "H" or masks.typecode != "I" or len(masks) != length:
+        raise ValueError("opcodes and masks do not match")
+    for index in range(length):
+        if opcodes.data.as_ushorts[index] >= len(names):
+            raise ValueError("unknown opcode %d" % opcodes.data.as_ushorts[index])
+        seen |= masks.data.as_uints[index]
+    program.names = names
+    for opcode, methodname in enumerate(names):
+        program.opcode_of[methodname] = opcode
+    program.opcodes = opcodes
+    program.masks = masks
+    program.length = program.capacity = length
+    for letter in range(26):
+        if LETTERS[letter] in columns:
+            column = columns[LETTERS[letter]]
+            if column.typecode != "d" or len(column) != length:
+                raise ValueError("column %s does not match" % LETTERS[letter])
+            program.column_index[letter] = len(program.column_list)
+            program.column_list.append(column)
+            program.columns[LETTERS[letter]] = column
+        elif seen & (1 << letter):
+            raise ValueError("column %s is missing" % LETTERS[letter])
+    program.code_values = code_values
+    return(program)
 
 
 cdef class Parser(object):
@@ -20,31 +336,52 @@ cdef class Parser(object):
 
     cdef str filename
     cdef int autorun
+    cdef int use_mmap
     cdef object controller
     cdef object gui_cb
+    cdef object cache
     cdef list calls
+    cdef list buffer
+    cdef dict words
+    cdef dict handlers
+    cdef Program program
+    cdef unsigned long long word_keys[WORD_SLOTS]
+    cdef PyObject *word_values[WORD_SLOTS]
     cdef public str last_g_code
 
-    def __init__(self, str filename, int autorun):
+    def __init__(self, str filename, int autorun, int use_mmap=False):
         """
         @params
         filename -> filename to read G-Codes from
         autorun -> should controller method calles automatically be initialized
             after parssing of file is done, or not
+        use_mmap -> scan the memory mapped file byte by byte, instead of
+            reading it line by line, no python objects are created per line
         """
         self.filename = filename
         self.autorun = autorun
+        self.use_mmap = use_mmap
         # last known g code
         self.last_g_code = ""
         # initial values
         self.controller = None
         self.gui_cb = None
+        self.cache = None
         # call list
         self.calls = []
+        # list where caller() stores the commands
+        self.buffer = self.calls
+        # cache of already seen G/M/F/S/T words
+        self.words = {}
+        # methods to call, by methodname
+        self.handlers = {}
+        # packed program, if read_program() is parsing
+        self.program = None
 
     cpdef int set_controller(self, object controller):
         """set controller object, must be done prior to parse() call"""
         self.controller = controller
+        self.handlers = {}
         return(0)
 
     cpdef int set_gui_cb(self, object gui_cb):
@@ -55,6 +392,14 @@ cdef class Parser(object):
         self.gui_cb = gui_cb
         return(0)
 
+    cpdef int set_cache(self, object cache):
+        """
+        set ParserCache object, read_program() will load the Program from cache
+        if the file was already parsed, or store it after parsing
+        """
+        self.cache = cache
+        return(0)
+
     cdef int caller(self, str methodname, object args):
         """
         calls G- or M- code Method
@@ -64,8 +409,13 @@ cdef class Parser(object):
         for example G02 results in call of self.controller.G02(args)
         """
         # logging.debug("calling %s(%s)", methodname, args)
-        method_to_call = getattr(self.controller, methodname)
-        self.calls.append((method_to_call, args, methodname))
+        method_to_call = None
+        if self.controller is not None:
+            method_to_call = self.handlers.get(methodname)
+            if method_to_call is None:
+                method_to_call = self.controller.get_handler(methodname)
+                self.handlers[methodname] = method_to_call
+        self.buffer.append((method_to_call, args, methodname))
         # method_to_call(args)
         if methodname[0] == "G":
             self.last_g_code = methodname
@@ -77,70 +427,376 @@ cdef class Parser(object):
         for (method_to_call, args, methodname) in self.calls:
             logging.info("calling %s(%s)", methodname, args)
             method_to_call(args)
+        self.controller.flush()
+        self.controller.report_unsupported()
+        return(0)
+
+    cdef str word(self, const char *buf, Py_ssize_t start, Py_ssize_t end):
+        """
+        return characters buf[start:end] as uppercase str
+        words like G01 or M3 are repeated very often, so they are cached
+
+        words up to 8 characters are packed into an integer and looked up
+        in a small C table first, so no bytes object has to be created
+        self.words holds the references to all cached words
+        """
+        cdef unsigned long long packed = 0
+        cdef unsigned char c
+        cdef int slot = 0
+        cdef Py_ssize_t pos
+        cdef bytes key
+        cdef str word
+        if end - start <= 8:
+            for pos in range(start, end):
+                c = buf[pos]
+                if c >= c'a':
+                    c &= 0xDF
+                packed = (packed << 8) | c
+            slot = (packed * 0x9E3779B97F4A7C15ULL) >> 56
+            if self.word_keys[slot] == packed:
+                return(<str>self.word_values[slot])
+        key = buf[start:end]
+        try:
+            word = self.words[key]
+        except KeyError:
+            word = str(key.upper().decode("ascii"))
+            self.words[key] = word
+        if packed != 0:
+            self.word_keys[slot] = packed
+            self.word_values[slot] = <PyObject *>word
+        return(word)
+
+    cdef int parse_line(self, const char *buf, Py_ssize_t start, Py_ssize_t end) except -1:
+        """
+        parse one line buf[start:end] of G-Code in one single pass
+
+        every word, a letter followed by a number, is classified by its letter
+        parameters ("X", "Y", "Z", "I", "J", "K", "P", "R", ...) are collected
+        F, S and T Codes are called first, with their value as string
+        G and M Codes are called afterwards, with the collected parameters
+        if there are parameters but no G Code, the last G Code will be repeated
+
+        comments in brackets are skipped
+        """
+        cdef double values[26]
+        cdef int seen = 0
+        cdef Py_ssize_t code_start[MAX_WORDS]
+        cdef Py_ssize_t code_end[MAX_WORDS]
+        cdef Py_ssize_t gcode_start[MAX_WORDS]
+        cdef Py_ssize_t gcode_end[MAX_WORDS]
+        cdef int code_count = 0
+        cdef int gcode_count = 0
+        cdef int remaining = 0
+        cdef int kind, index
+        cdef unsigned char c, letter
+        cdef Py_ssize_t pos, number, number_end
+        cdef dict params
+        # cleanup line
+        while start < end and <unsigned char>buf[start] <= 32:
+            start += 1
+        while end > start and <unsigned char>buf[end - 1] <= 32:
+            end -= 1
+        # filter out some incorrect lines
+        # blank lines
+        # lines beginning with % or (
+        if start == end or buf[start] == c'%' or buf[start] == c'(':
+            return(0)
+        pos = start
+        while pos < end:
+            c = buf[pos]
+            if c == c'(':
+                # skip comment up to closing bracket
+                while pos < end and buf[pos] != c')':
+                    pos += 1
+                pos += 1
+                continue
+            letter = c & 0xDF
+            if letter < c'A' or letter > c'Z':
+                if c > 32:
+                    remaining = 1
+                pos += 1
+                continue
+            index = letter - c'A'
+            kind = WORD_KINDS[index]
+            number = pos + 1
+            if kind == WORD_PARAM and number < end and (buf[number] == c'+' or buf[number] == c'-'):
+                number += 1
+            number_end = number
+            while number_end < end and (c'0' <= buf[number_end] <= c'9' or buf[number_end] == c'.'):
+                number_end += 1
+            if kind == WORD_NONE or number_end == number:
+                remaining = 1
+                pos += 1
+                continue
+            if kind == WORD_PARAM:
+                # only the first occurence of every parameter counts
+                if not seen & (1 << index):
+                    values[index] = parse_number(buf, pos + 1, number_end)
+                    seen |= 1 << index
+            elif kind == WORD_CODE and code_count < MAX_WORDS:
+                code_start[code_count] = pos
+                code_end[code_count] = number_end
+                code_count += 1
+            elif kind == WORD_GCODE and gcode_count < MAX_WORDS:
+                gcode_start[gcode_count] = pos
+                gcode_end[gcode_count] = number_end
+                gcode_count += 1
+            else:
+                remaining = 1
+            pos = number_end
+        if self.program is not None:
+            return(self.append_line(buf, values, seen, code_start, code_end, code_count, gcode_start, gcode_end, gcode_count))
+        # Feed Rate has precedence over G
+        for index in range(code_count):
+            self.caller(self.word(buf, code_start[index], code_start[index] + 1), self.word(buf, code_start[index] + 1, code_end[index]))
+        params = {}
+        for index in range(26):
+            if seen & (1 << index):
+                params[LETTERS[index]] = values[index]
+        if seen and gcode_count == 0:
+            self.caller(self.last_g_code, params)
+        for index in range(gcode_count):
+            self.caller(self.word(buf, gcode_start[index], gcode_end[index]), params)
+        # remaining words should be of no interest
+        if remaining:
+            logging.debug("remaining: %s", buf[start:end])
+        return(0)
+
+    cdef int append_line(self, const char *buf, double *values, int seen,
+            Py_ssize_t *code_start, Py_ssize_t *code_end, int code_count,
+            Py_ssize_t *gcode_start, Py_ssize_t *gcode_end, int gcode_count) except -1:
+        """
+        append the words of one line to self.program, in the same order as
+        parse_line() calls them
+        """
+        cdef unsigned int same = 0
+        cdef int index
+        cdef str methodname
+        for index in range(code_count):
+            methodname = self.word(buf, code_start[index], code_start[index] + 1)
+            self.program.append_code(methodname, parse_number(buf, code_start[index] + 1, code_end[index]))
+            self.gui_cb()
+        if seen and gcode_count == 0:
+            self.program.append(self.last_g_code, values, seen)
+            self.gui_cb()
+        for index in range(gcode_count):
+            methodname = self.word(buf, gcode_start[index], gcode_end[index])
+            self.program.append(methodname, values, seen | same)
+            # following G or M Codes of this line share the parameters
+            same = SAME_PARAMS
+            if methodname[0] == "G":
+                self.last_g_code = methodname
+            self.gui_cb()
+        return(0)
+
+    cdef Py_ssize_t parse_next_line(self, const char *buf, Py_ssize_t start, Py_ssize_t length) except -1:
+        """
+        parse line starting at buf[start] up to the next newline
+        returns start of the following line
+        """
+        cdef const char *newline = <const char *>memchr(buf + start, c'\n', length - start)
+        cdef Py_ssize_t end = length if newline == NULL else newline - buf
+        self.parse_line(buf, start, end)
+        return(end + 1)
+
+    cdef object open_mmap(self, object f):
+        """
+        return read only memory map of whole file f,
+        or None for empty files, which could not be mapped
+        """
+        if os.fstat(f.fileno()).st_size == 0:
+            return(None)
+        return(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    cdef int parse_mmap(self, object f, Py_ssize_t start=0, Py_ssize_t end=-1) except -1:
+        """
+        parse file f memory mapped, without creating python objects per line
+        start and end select a part of the file, which must begin and end
+        on line boundaries, by default the whole file is parsed
+        """
+        cdef Py_buffer view
+        data = self.open_mmap(f)
+        if data is None:
+            return(0)
+        PyObject_GetBuffer(data, &view, PyBUF_SIMPLE)
+        try:
+            if end < 0 or end > view.len:
+                end = view.len
+            while start < end:
+                start = self.parse_next_line(<const char *>view.buf, start, end)
+        finally:
+            PyBuffer_Release(&view)
+            data.close()
+        return(0)
+
+    cdef int parse_parallel(self, int processes) except -1:
+        """
+        split file on line boundaries in chunks, parse the chunks in a pool
+        of processes and append the resulting Programs in order to self.program
+
+        the only modal state of the parser is the last G Code, it is
+        resolved while merging, so the result is the same as parsing
+        the whole file at once
+        G90/G91 and other modal states are handled by the controller,
+        when the commands are called in order
+        """
+        cdef list bounds = [0]
+        cdef long size = os.path.getsize(self.filename)
+        with open(self.filename, "rb") as f:
+            for index in range(1, processes):
+                # move to the beginning of the next line
+                f.seek(max(size * index // processes, bounds[-1]))
+                f.readline()
+                bounds.append(f.tell())
+        bounds.append(size)
+        chunks = [(self.filename, bounds[index], bounds[index + 1]) for index in range(processes) if bounds[index] < bounds[index + 1]]
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(parse_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+        for (program, last_g_code) in results:
+            self.program.extend(program, self.last_g_code)
+            if last_g_code != UNKNOWN_G_CODE:
+                self.last_g_code = last_g_code
+            # once per chunk, the commands are not visited one by one
+            self.gui_cb()
         return(0)
 
     cpdef int read(self):
         """
         read input file line by line, and parse gcode Commands
         """
-        fd = os.open(self.filename, os.O_RDONLY)
-        f = os.fdopen(fd, "r")
-        # precompile regular expressions
-        cdef dict rex_g = {}
-        cdef set g_params = set(("X", "Y", "Z", "I", "J", "K", "P", "R", "K", "U", "V", "W", "A", "B", "C"))
-        for g_param in g_params:
-            rex_g[g_param] = re.compile("(%s[\+\-]?[\d\.]+)\D?" % g_param)
-        # regex compilation
-        codes_rex = re.compile("([F|S|T][\d|\.]+)\D?")
-        gcodes_rex = re.compile("([G|M][\d|\.]+)\D?")
-        comment_rex = re.compile("^\((.*)\)?$")
-        for line in f:
-            # cleanup line
-            line = line.strip()
-            line = line.upper()
-            # filter out some incorrect lines
-            # blank lines
-            # lines beginning with % or ( 
-            if len(line) == 0 or line[0] == "%" or line[0] == "(": 
-                continue
-            # start of parsing
-            
-            #comment = comment_rex.match(line)
-            #if comment is not None:
-            #    #logging.info("ignoring: %s", comment.group(0))
-            #    continue
-
-            #logging.info("parsing: %s", line)
-            # first determine if this line is something of G-Command or M-Command
-            # if that line is after a modal G or M Code, there are only 
-            # G Parameters ("X", "Y", "Z", "F", "I", "J", "K", "P", "R")
-            # M Parameters ("S")
-            # search for M-Codes
-            # Feed Rate has precedence over G
-            params = {}
-            for parameter in g_params:
-                match = rex_g[parameter].search(line)
-                if match:
-                    params[parameter] = float(match.group(1)[1:])
-                    line = line.replace(match.group(1), "")
-            codes = codes_rex.findall(line)
-            if codes is not None:
-                for code in codes:
-                    self.caller(code[0], code[1:])
-                    line = line.replace(code, "")
-            gcodes = gcodes_rex.findall(line)
-            if (len(params) > 0) and (len(gcodes) == 0):
-                gcodes.append(self.last_g_code)
-            for code in gcodes:
-                self.caller(code, params)
-                line = line.replace(code, "")
-            # remaining line should be of no interest
-            remaining_line = line.strip()
-            if len(remaining_line) > 0:
-                logging.debug("remaining: %s", line)
+        cdef bytes line
+        self.buffer = self.calls
+        # self.calls grows by one tuple per command and contains no cycles,
+        # so the cyclic garbage collector would only scan it over and over
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            with open(self.filename, "rb") as f:
+                if self.use_mmap:
+                    self.parse_mmap(f)
+                else:
+                    for line in f:
+                        self.parse_line(line, 0, len(line))
+        finally:
+            if gc_enabled:
+                gc.enable()
         logging.info("parsing done")
         if self.autorun is True:
             self.run()
         else:
             logging.info("You have to call run(), to call Controller methods")
         return(0)
+
+    cpdef Program read_program(self, int processes=1):
+        """
+        read input file and return the parsed commands as packed Program,
+        instead of storing them in self.calls
+
+        processes -> if greater than 1, the file is split and parsed
+            in this number of processes, their Programs are merged in bulk
+
+        with a ParserCache, an already parsed file is loaded from cache
+        directly into the arrays of the Program
+
+        for example
+        controller.consume_program(parser.read_program())
+        """
+        cdef bytes line
+        cdef Program program
+        cdef object parts = None
+        if self.cache is not None:
+            key = self.cache.key(self.filename, PARSER_VERSION)
+            parts = self.cache.load(key)
+        if parts is not None:
+            try:
+                program = unpack_program(*parts)
+            except ValueError as exc:
+                logging.error("ignoring cached program : %s", exc)
+            else:
+                logging.info("using cached program, %d commands in %d bytes", len(program), program.nbytes())
+                self.gui_cb()
+                return(program)
+        program = Program()
+        self.program = program
+        try:
+            if processes > 1:
+                self.parse_parallel(processes)
+            else:
+                with open(self.filename, "rb") as f:
+                    if self.use_mmap:
+                        self.parse_mmap(f)
+                    else:
+                        for line in f:
+                            self.parse_line(line, 0, len(line))
+        finally:
+            self.program = None
+        program.trim()
+        logging.info("parsing done, %d commands in %d bytes", len(program), program.nbytes())
+        if self.cache is not None:
+            self.cache.store(key, program.parts())
+        return(program)
+
+    def iter_commands(self):
+        """
+        read input file line by line, and yield the parsed commands
+        (method_to_call, args, methodname) as soon as their line is parsed
+
+        nothing is stored in self.calls, so memory stays constant
+        regardless of file size, and the first command is available
+        before the whole file is read
+
+        for example
+        controller.consume(parser.iter_commands())
+        """
+        cdef bytes line
+        cdef list buffer = []
+        cdef Py_buffer view
+        cdef Py_ssize_t start = 0
+        self.buffer = buffer
+        with open(self.filename, "rb") as f:
+            data = self.open_mmap(f) if self.use_mmap else None
+            if data is not None:
+                PyObject_GetBuffer(data, &view, PyBUF_SIMPLE)
+                try:
+                    while start < view.len:
+                        start = self.parse_next_line(<const char *>view.buf, start, view.len)
+                        if buffer:
+                            for command in buffer:
+                                yield command
+                            del buffer[:]
+                finally:
+                    PyBuffer_Release(&view)
+                    data.close()
+            else:
+                for line in f:
+                    self.parse_line(line, 0, len(line))
+                    if buffer:
+                        for command in buffer:
+                            yield command
+                        del buffer[:]
+
+
+def parse_chunk(tuple chunk):
+    """
+    parse part of file in a worker process
+    chunk is (filename, start, end), start and end on line boundaries
+
+    returns (program, last_g_code), lines with parameters but without
+    G Code before the first G Code of this chunk use UNKNOWN_G_CODE,
+    last_g_code is UNKNOWN_G_CODE if there is no G Code in this chunk
+    """
+    cdef Parser parser
+    cdef Program program = Program()
+    filename, start, end = chunk
+    parser = Parser(filename, False, True)
+    parser.set_gui_cb(lambda: None)
+    parser.last_g_code = UNKNOWN_G_CODE
+    parser.program = program
+    with open(filename, "rb") as f:
+        parser.parse_mmap(f, start, end)
+    program.trim()
+    return((program, parser.last_g_code))
@@ -0,0 +1,210 @@
+#/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# parse Gcode
+#
+"""
+On-Disk Cache for parsed G-Code Programs
+"""
+import os
+import struct
+import hashlib
+import logging
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+from cpython cimport array
+# own modules
+from StepBuffer import array_bytes as array_bytes
+from StepBuffer import extend_bytes as extend_bytes
+
+# file format version, change if binary layout changes
+FORMAT_VERSION = 2
+MAGIC = b"GCODECACHE"
+
+# header, format version, number of methodnames, number of commands,
+# bitmask of stored columns, number of F, S and T Code values
+HEADER = struct.Struct("=%dsIIIII" % len(MAGIC))
+# string length
+STRING = struct.Struct("=H")
+# parameter names, indexed by letter
+cdef tuple LETTERS = tuple(chr(65 + index) for index in range(26))
+
+
+cdef bytes take(bytes data, Py_ssize_t *pos, Py_ssize_t size):
+    """
+    return size bytes of data starting at pos[0], and move pos behind them
+    """
+    if pos[0] + size > len(data):
+        raise ValueError("truncated data")
+    pos[0] += size
+    return(data[pos[0] - size:pos[0]])
+
+
+cpdef bytes encode(tuple parts):
+    """
+    return binary representation of Program.parts()
+
+    after the header and the table of methodnames follow the raw arrays
+    opcodes, masks, one column of doubles per letter in the column bitmask,
+    the command indices and values of F, S and T Codes
+    """
+    names, opcodes, masks, columns, code_values = parts
+    cdef unsigned int column_mask = 0
+    cdef int index
+    cdef array.array code_index = array.array("I", sorted(code_values))
+    cdef array.array code_value = array.array("d", [code_values[command] for command in code_index])
+    for index in range(26):
+        if LETTERS[index] in columns:
+            column_mask |= 1 << index
+    data = [HEADER.pack(MAGIC, FORMAT_VERSION, len(names), len(opcodes), column_mask, len(code_index))]
+    for methodname in names:
+        encoded = methodname.encode("ascii")
+        data.append(STRING.pack(len(encoded)))
+        data.append(encoded)
+    data.append(array_bytes(opcodes))
+    data.append(array_bytes(masks))
+    for index in range(26):
+        if column_mask & (1 << index):
+            data.append(array_bytes(columns[LETTERS[index]]))
+    data.append(array_bytes(code_index))
+    data.append(array_bytes(code_value))
+    return(b"".join(data))
+
+
+cpdef tuple decode(bytes data):
+    """
+    return (names, opcodes, masks, columns, code_values) from binary
+    representation, like Program.parts()
+    raises ValueError if data is not valid
+    """
+    cdef Py_ssize_t pos = HEADER.size
+    cdef unsigned int count
+    cdef unsigned short string_length
+    cdef int index
+    cdef list names = []
+    cdef dict columns = {}
+    cdef array.array opcodes = array.array("H")
+    cdef array.array masks = array.array("I")
+    cdef array.array code_index = array.array("I")
+    cdef array.array code_value = array.array("d")
+    cdef array.array column
+    if len(data) < HEADER.size:
+        raise ValueError("file too short")
+    magic, version, string_count, length, column_mask, code_count = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError("unknown format")
+    for count in range(string_count):
+        (string_length, ) = STRING.unpack(take(data, &pos, STRING.size))
+        names.append(str(take(data, &pos, string_length).decode("ascii")))
+    extend_bytes(opcodes, take(data, &pos, length * opcodes.itemsize))
+    extend_bytes(masks, take(data, &pos, length * masks.itemsize))
+    for index in range(26):
+        if column_mask & (1 << index):
+            column = array.array("d")
+            extend_bytes(column, take(data, &pos, length * column.itemsize))
+            columns[LETTERS[index]] = column
+    extend_bytes(code_index, take(data, &pos, code_count * code_index.itemsize))
+    extend_bytes(code_value, take(data, &pos, code_count * code_value.itemsize))
+    if pos != len(data):
+        raise ValueError("trailing data")
+    return((names, opcodes, masks, columns, dict(zip(code_index, code_value))))
+
+
+cdef class ParserCache(object):
+    """
+    Class to store parsed G-Code Programs in a compact binary format
+
+    the arrays of a packed Program are stored as they are in memory,
+    a table of methodnames, opcodes, letter bitmasks and one column of
+    doubles per used letter, so loading creates no object per command
+
+    entries are keyed by a content hash of the source file and the parser version,
+    if the cache directory grows above max_size, the least recently used entries
+    are removed
+    """
+
+    cdef str directory
+    cdef long max_size
+
+    def __init__(self, str directory, long max_size=64 * 1024 * 1024):
+        """
+        @params
+        directory -> where cache entries are stored, will be created
+        max_size -> maximum size of all cache entries in bytes
+        """
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    cpdef str key(self, str filename, int version):
+        """
+        return hash of file content and parser version
+        """
+        digest = hashlib.sha1()
+        digest.update(("%s:%d:" % (FORMAT_VERSION, version)).encode("ascii"))
+        with open(filename, "rb") as f:
+            chunk = f.read(1024 * 1024)
+            while chunk:
+                digest.update(chunk)
+                chunk = f.read(1024 * 1024)
+        return(str(digest.hexdigest()))
+
+    cdef str path(self, str key):
+        """return filename of cache entry"""
+        return(os.path.join(self.directory, "%s.gcc" % key))
+
+    cpdef object load(self, str key):
+        """
+        return parts of the Program stored under key, like Program.parts(),
+        or None if there is no valid entry
+        """
+        cdef str path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except (IOError, OSError):
+            return(None)
+        try:
+            parts = decode(data)
+        except (ValueError, UnicodeDecodeError, struct.error) as exc:
+            logging.error("ignoring invalid cache entry %s : %s", path, exc)
+            return(None)
+        # remember last usage for eviction
+        os.utime(path, None)
+        return(parts)
+
+    cpdef int store(self, str key, tuple parts):
+        """
+        store parts of Program, from Program.parts(), under key
+        """
+        cdef str path = self.path(key)
+        cdef str temp_path = "%s.%d" % (path, os.getpid())
+        with open(temp_path, "wb") as f:
+            f.write(encode(parts))
+        os.rename(temp_path, path)
+        self.evict()
+        return(0)
+
+    cpdef int evict(self):
+        """
+        remove least recently used entries, until the size of all
+        entries is below max_size
+        """
+        cdef long size = 0
+        entries = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".gcc"):
+                continue
+            path = os.path.join(self.directory, filename)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+            size += stat.st_size
+        entries.sort()
+        for mtime, entry_size, path in entries:
+            if size <= self.max_size:
+                break
+            logging.info("removing cache entry %s", path)
+            os.remove(path)
+            size -= entry_size
+        return(0)
@@ -0,0 +1,152 @@
+#/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# parse Gcode
+#
+"""
+Pipelined execution of G-Code Programs
+
+parser, controller and motors run in three threads, connected by bounded queues,
+so motors start to move while the rest of the file is parsed and planned
+"""
+import logging
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+cdef class Pipeline(object):
+    """
+    Class to run parser, controller and motors at the same time
+
+    parse thread -> parsed commands from Parser.iter_commands()
+    plan thread -> calls the controller methods, and takes the motor commands
+        with Controller.drain()
+    execute thread -> executes the motor commands
+
+    queues are bounded, so a fast thread waits for the slower one after it,
+    controller should be created with autorun=False
+    """
+
+    cdef object parser
+    cdef object controller
+    cdef object commands
+    cdef object motor_commands
+    cdef object stop
+    cdef object error
+
+    def __init__(self, object parser, object controller, int queue_size=256):
+        """
+        @params
+        parser -> Parser object, with controller set
+        controller -> Controller object
+        queue_size -> maximum number of entries in every queue
+        """
+        self.parser = parser
+        self.controller = controller
+        self.commands = queue.Queue(queue_size)
+        self.motor_commands = queue.Queue(queue_size)
+        self.stop = controller.stop
+        self.error = None
+
+    cdef int put(self, object target, object item):
+        """put item in queue target, returns False if pipeline was stopped"""
+        while not self.stop.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return(True)
+            except queue.Full:
+                pass
+        return(False)
+
+    cdef object get(self, object source):
+        """get next item from queue source, None if pipeline was stopped"""
+        while not self.stop.is_set():
+            try:
+                return(source.get(timeout=0.1))
+            except queue.Empty:
+                pass
+        return(None)
+
+    def parse(self):
+        """parse thread"""
+        try:
+            for command in self.parser.iter_commands():
+                if not self.put(self.commands, command):
+                    return
+            self.put(self.commands, None)
+        except Exception as exc:
+            self.fail(exc)
+
+    def plan(self):
+        """plan thread"""
+        try:
+            while True:
+                command = self.get(self.commands)
+                if command is None:
+                    break
+                (method_to_call, args, methodname) = command
+                method_to_call(args)
+                for motor_command in self.controller.drain():
+                    if not self.put(self.motor_commands, motor_command):
+                        return
+            if self.stop.is_set():
+                return
+            self.controller.flush()
+            self.controller.report_unsupported()
+            for motor_command in self.controller.drain():
+                if not self.put(self.motor_commands, motor_command):
+                    return
+            self.put(self.motor_commands, None)
+        except Exception as exc:
+            self.fail(exc)
+
+    def execute(self):
+        """execute thread"""
+        try:
+            while True:
+                motor_command = self.get(self.motor_commands)
+                if motor_command is None:
+                    break
+                (method_to_call, args) = motor_command
+                method_to_call(*args)
+        except Exception as exc:
+            self.fail(exc)
+
+    def fail(self, exc):
+        """remember first exception of any thread and stop all others"""
+        if self.error is None:
+            self.error = exc
+        self.controller.abort()
+
+    def run(self):
+        """
+        start all threads and wait until the motors are done
+
+        on KeyboardInterrupt all threads are stopped, motors stop after the
+        current step, and the exception is raised again.
+        exceptions in one of the threads are raised here too
+        an abort before this run does not stop it
+        """
+        self.controller.stop.clear()
+        self.error = None
+        threads = [threading.Thread(target=target, name=target.__name__) for target in (self.parse, self.plan, self.execute)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for thread in threads:
+                # join with timeout, so KeyboardInterrupt is delivered
+                while thread.is_alive():
+                    thread.join(0.1)
+        except KeyboardInterrupt:
+            logging.info("stopping pipeline")
+            self.controller.abort()
+            for thread in threads:
+                thread.join()
+            raise
+        if self.error is not None:
+            raise self.error
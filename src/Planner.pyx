@@ -0,0 +1,314 @@
+#/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# parse Gcode
+#
+"""
+Segment Planner for Controller
+
+calculates the motor steps of a run of linear segments at once with numpy,
+instead of one step after another
+"""
+import numpy
+
+from libc.math cimport sqrt
+# own modules
+from StepBuffer import StepBuffer as StepBuffer
+from StepBuffer import array_bytes as array_bytes
+
+
+cdef class StepPlan(object):
+    """
+    motor steps of a run of segments, one row per tick
+
+    positions -> (ticks, 3) int64, position of X, Y, Z motor in steps after tick
+    directions -> (ticks, 3) int8, step of X, Y, Z motor in tick, 1, -1 or 0
+    times -> (ticks, ) float64, time of tick in seconds after start of plan
+    """
+
+    cdef public object positions
+    cdef public object directions
+    cdef public object times
+
+    def __init__(self, positions, directions, times):
+        self.positions = positions
+        self.directions = directions
+        self.times = times
+
+    def __len__(self):
+        return(self.times.shape[0])
+
+    cpdef object events(self):
+        """
+        return ticks as events like in StepBuffer, bit 0, 1, 2 for a step of
+        X, Y, Z and bit 4, 5, 6 if this step is in negative direction
+        """
+        directions = self.directions
+        events = ((directions != 0) * numpy.array([1, 2, 4])).sum(axis=1) | ((directions < 0) * numpy.array([16, 32, 64])).sum(axis=1)
+        return(events.astype(numpy.uint8))
+
+    cpdef int pack(self, object buffer):
+        """
+        append all ticks to StepBuffer buffer,
+        equal consecutive ticks as one run
+        """
+        events = self.events()
+        delays = numpy.diff(self.times, prepend=0.0).astype(numpy.float32)
+        # first tick of every run
+        first = numpy.ones(events.shape[0], dtype=bool)
+        first[1:] = (events[1:] != events[:-1]) | (delays[1:] != delays[:-1])
+        first = numpy.flatnonzero(first)
+        counts = numpy.diff(numpy.append(first, events.shape[0]))
+        buffer.extend(events[first].tobytes(), counts.astype(numpy.uint32).tobytes(), delays[first].tobytes())
+        return(0)
+
+    cpdef int run(self, object scheduler, object stop=None, object timer=None):
+        """
+        execute plan with StepScheduler scheduler,
+        on the timeline of StepTimer timer, if given,
+        returns early if threading.Event stop is set
+        """
+        buffer = StepBuffer()
+        self.pack(buffer)
+        return(buffer.run(scheduler, stop, timer))
+
+
+cdef class SegmentPlanner(object):
+    """
+    collects target positions in motor steps of linear segments,
+    and calculates all steps of these segments in one pass
+
+    steps are the same as in the integer DDA of Controller, in every segment
+    the axis with the most steps is stepped every tick, the others are at
+    round(steps * tick / ticks) after tick
+
+    tick times follow a trapezoidal velocity profile over all collected
+    segments, with speed at the junction of two segments limited by
+    junction deviation, like in grbl, or zero in exact stop mode.
+    the run ends at rest, if plan is called with final, otherwise the
+    segments within braking distance of the end are kept for the next
+    call, which starts with their planned speed.
+    positions are in motor steps, lengths are in units of G-Code
+    like mm, speeds in units per second along the path and
+    acceleration in units per second^2
+    """
+
+    cdef list targets
+    cdef list lengths
+    cdef list speeds
+    cdef long position[3]
+    cdef double entry_speed
+    cdef public int max_segments
+    cdef public double acceleration
+    cdef public double junction_deviation
+    cdef public int exact_stop
+
+    def __init__(self, int max_segments=1024, double acceleration=0.0, double junction_deviation=0.0):
+        """
+        @params
+        max_segments -> number of segments to collect, before plan should be called
+        acceleration -> maximum acceleration, 0.0 means no limit,
+            every segment runs at its own speed
+        junction_deviation -> allowed deviation from the exact corner
+            at the junction of two segments, bigger values mean faster corners
+        """
+        self.targets = []
+        self.lengths = []
+        self.speeds = []
+        self.max_segments = max_segments
+        self.acceleration = acceleration
+        self.junction_deviation = junction_deviation
+        self.exact_stop = False
+        # speed at start of the next segment, not at rest after plan without final
+        self.entry_speed = 0.0
+        self.position[0] = 0
+        self.position[1] = 0
+        self.position[2] = 0
+
+    def __len__(self):
+        return(len(self.targets))
+
+    cpdef int set_position(self, long x, long y, long z):
+        """set position in motor steps, where the next segment starts"""
+        self.position[0] = x
+        self.position[1] = y
+        self.position[2] = z
+        return(0)
+
+    cpdef int add(self, long x, long y, long z, double length, double speed=0.0):
+        """
+        add target position of segment in motor steps,
+        length of segment and speed, 0.0 means as fast as possible,
+        returns True if max_segments are collected
+        """
+        self.targets.append((x, y, z))
+        self.lengths.append(length)
+        self.speeds.append(speed if speed > 0.0 else numpy.inf)
+        return(len(self.targets) >= self.max_segments)
+
+    cpdef object plan(self, double delay, int final=True):
+        """
+        return StepPlan of collected segments, or None if there are no steps
+        ticks are at least delay seconds apart
+
+        if final, all segments are planned and the plan ends at rest,
+        otherwise the segments within braking distance of the end stay
+        in the planner, so the motors do not stop between two plans
+        """
+        chunk = self.take(delay, final)
+        if chunk is None:
+            return(None)
+        return(plan_steps(chunk, self.acceleration))
+
+    cpdef object take(self, double delay, int final=True):
+        """
+        plan speeds at the start of every collected segment, like plan,
+        and return chunk (start, targets, lengths, speeds, entry_speeds)
+        of segments with steps for plan_steps or plan_chunk,
+        entry_speeds has one more entry, the speed at the end of the last
+        segment, or None if there are no steps
+
+        only the steps of the chunk are left to calculate, chunks of
+        consecutive calls join at their planned speed
+        """
+        cdef Py_ssize_t count, keep, index
+        if len(self.targets) == 0:
+            return(None)
+        start = numpy.array([self.position[0], self.position[1], self.position[2]], dtype=numpy.int64)
+        targets = numpy.array(self.targets, dtype=numpy.int64)
+        lengths = numpy.array(self.lengths, dtype=numpy.float64)
+        speeds = numpy.array(self.speeds, dtype=numpy.float64)
+        # start of every segment is the end of the previous one
+        deltas = targets - numpy.vstack((start, targets[:-1]))
+        ticks = numpy.abs(deltas).max(axis=1)
+        moving = numpy.flatnonzero(ticks > 0)
+        count = moving.shape[0]
+        if count == 0:
+            self.position[0], self.position[1], self.position[2] = targets[-1]
+            self.targets = []
+            self.lengths = []
+            self.speeds = []
+            return(None)
+        targets = targets[moving]
+        deltas = deltas[moving]
+        lengths = lengths[moving]
+        speeds = speeds[moving]
+        # no tick faster than motors allow
+        if delay > 0.0:
+            speeds = numpy.minimum(speeds, lengths / ticks[moving] / delay)
+        keep = count
+        if self.acceleration > 0.0:
+            units = deltas / numpy.sqrt((deltas.astype(numpy.float64) ** 2).sum(axis=1))[:, None]
+            entry_speeds = self.entry_speeds(units, lengths, speeds)
+            if not final:
+                # keep segments from the end, until the fastest speed reached
+                # could be braked to rest in them, but plan at least half
+                peak = numpy.minimum(speeds, numpy.sqrt(entry_speeds[:-1] ** 2 + 2 * self.acceleration * lengths)).max()
+                braking = numpy.cumsum(lengths[::-1])
+                keep = count - 1 - numpy.searchsorted(braking, peak * peak / (2 * self.acceleration))
+                keep = max(keep, count // 2)
+                if keep == 0:
+                    return(None)
+        else:
+            entry_speeds = numpy.zeros(count + 1)
+        if keep < count:
+            # remaining segments start at the target of the last planned one
+            index = moving[keep]
+            self.targets = self.targets[index:]
+            self.lengths = self.lengths[index:]
+            self.speeds = self.speeds[index:]
+            self.position[0], self.position[1], self.position[2] = targets[keep - 1]
+            self.entry_speed = entry_speeds[keep]
+        else:
+            self.position[0], self.position[1], self.position[2] = self.targets[-1]
+            self.targets = []
+            self.lengths = []
+            self.speeds = []
+            self.entry_speed = 0.0
+        return((start, targets[:keep], lengths[:keep], speeds[:keep], entry_speeds[:keep + 1]))
+
+    cdef object entry_speeds(self, object units, object lengths, object speeds):
+        """
+        return maximum speed at start of every segment, so that every
+        following segment can be reached with acceleration, and the last
+        segment ends at rest, with one more entry for the end of the
+        last segment, the first segment starts with entry_speed
+        """
+        cdef double[:] entry
+        cdef const double[:] length = lengths
+        cdef Py_ssize_t index
+        cdef Py_ssize_t count = lengths.shape[0]
+        cdef double acceleration = self.acceleration
+        cdef double reachable
+        # cosinus of angle between segments, -1 is straight on, 1 is reverse
+        cos_theta = numpy.clip(-(units[:-1] * units[1:]).sum(axis=1), -1.0, 1.0)
+        sin_theta_half = numpy.sqrt((1.0 - cos_theta) / 2.0)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            junction = numpy.sqrt(acceleration * self.junction_deviation * sin_theta_half / (1.0 - sin_theta_half))
+        # no limit if straight on, stop if reverse, also with infinite junction deviation
+        junction[sin_theta_half >= 1.0] = numpy.inf
+        junction[sin_theta_half <= 0.0] = 0.0
+        if self.exact_stop:
+            junction[:] = 0.0
+        # junction not faster than segments on both sides
+        junction = numpy.minimum(junction, numpy.minimum(speeds[:-1], speeds[1:]))
+        entry_speeds = numpy.append(self.entry_speed, junction)
+        entry = entry_speeds
+        # backward pass, brake in time for next entry speed
+        reachable = 0.0
+        for index in range(count - 1, -1, -1):
+            reachable = sqrt(reachable * reachable + 2 * acceleration * length[index])
+            if entry[index] > reachable:
+                entry[index] = reachable
+            else:
+                reachable = entry[index]
+        # forward pass, accelerate to next entry speed
+        reachable = self.entry_speed
+        for index in range(count):
+            if entry[index] > reachable:
+                entry[index] = reachable
+            reachable = sqrt(entry[index] * entry[index] + 2 * acceleration * length[index])
+        return(numpy.append(entry_speeds, 0.0))
+
+
+cpdef object plan_steps(tuple chunk, double acceleration):
+    """
+    return StepPlan of chunk from SegmentPlanner.take, every segment
+    accelerates from its entry speed and brakes to the entry speed of the next
+    """
+    (start, targets, lengths, speeds, entry_speeds) = chunk
+    starts = numpy.vstack((start, targets[:-1]))
+    deltas = targets - starts
+    ticks = numpy.abs(deltas).max(axis=1)
+    total = ticks.sum()
+    # segment and tick number inside segment of every tick
+    segment = numpy.repeat(numpy.arange(ticks.shape[0]), ticks)
+    tick = numpy.arange(1, total + 1) - numpy.repeat(numpy.cumsum(ticks) - ticks, ticks)
+    # integer rounding, round half up like the DDA error term
+    tick_ticks = ticks[segment][:, None]
+    tick_deltas = deltas[segment]
+    positions = starts[segment] + numpy.sign(tick_deltas) * ((2 * numpy.abs(tick_deltas) * tick[:, None] + tick_ticks) // (2 * tick_ticks))
+    directions = numpy.diff(positions, axis=0, prepend=start[None, :]).astype(numpy.int8)
+    # path length of one tick
+    tick_lengths = lengths / ticks
+    # speed in the middle of every tick
+    distance = (tick - 0.5) * tick_lengths[segment]
+    velocity = speeds[segment]
+    if acceleration > 0.0:
+        velocity = numpy.minimum(velocity, numpy.sqrt(entry_speeds[segment] ** 2 + 2 * acceleration * distance))
+        velocity = numpy.minimum(velocity, numpy.sqrt(entry_speeds[segment + 1] ** 2 + 2 * acceleration * (lengths[segment] - distance)))
+    times = numpy.cumsum(tick_lengths[segment] / velocity)
+    return(StepPlan(positions, directions, times))
+
+
+def plan_chunk(tuple chunk, double acceleration):
+    """
+    calculate steps of chunk from SegmentPlanner.take, in a worker process,
+    returns steps packed like StepBuffer as bytes of events, counts and delays
+
+    speeds at the start and end of chunk are planned already,
+    so chunks do not depend on each other, and join without stop
+    """
+    buffer = StepBuffer()
+    plan_steps(chunk, acceleration).pack(buffer)
+    return(array_bytes(buffer.events), array_bytes(buffer.counts), array_bytes(buffer.delays))
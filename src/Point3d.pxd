@@ -0,0 +1,85 @@
+#/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# parse Gcode
+#
+# C level declarations of Point3d, to cimport in other modules
+#
+# vec3 is a plain C vector, axis 0, 1, 2 for X, Y, Z,
+# the inline functions work on vec3 without python objects
+
+from libc.math cimport sqrt
+
+
+cdef struct vec3:
+    double axis[3]
+
+
+cdef class Point3d(object):
+
+    cdef public double X
+    cdef public double Y
+    cdef public double Z
+
+    cdef vec3 vec(self)
+    cpdef double get_axis(self, str axisname) except? -1
+    cpdef set_axis(self, str axisname, double value)
+    cpdef double length(self)
+    cpdef double lengthXY(self)
+    cpdef object unit(self)
+    cpdef object product(self, object other)
+    cpdef object rotated_z_fast(self, double theta, double cos_theta, double sin_theta)
+    cpdef object rotated_Z(self, double theta)
+    cpdef object rotated_Y(self, double theta)
+    cpdef object rotated_X(self, double theta)
+    cpdef double dot(self, object other)
+    cpdef double angle(self)
+    cpdef double angle_between(self, object other)
+
+
+cdef class PointArray(object):
+
+    cdef double[:, ::1] data
+
+    cdef vec3 vec(self, Py_ssize_t index)
+    cdef PointArray combine(self, object other, double sign)
+    cpdef object length(self)
+    cpdef object lengthXY(self)
+    cpdef PointArray unit(self)
+    cpdef PointArray rotated_Z(self, double theta)
+    cpdef object dot(self, object other)
+    cpdef object angle(self)
+
+
+cdef inline vec3 vec3_new(double x, double y, double z) noexcept nogil:
+    cdef vec3 result
+    result.axis[0] = x
+    result.axis[1] = y
+    result.axis[2] = z
+    return(result)
+
+cdef inline vec3 vec3_add(vec3 a, vec3 b) noexcept nogil:
+    return(vec3_new(a.axis[0] + b.axis[0], a.axis[1] + b.axis[1], a.axis[2] + b.axis[2]))
+
+cdef inline vec3 vec3_sub(vec3 a, vec3 b) noexcept nogil:
+    return(vec3_new(a.axis[0] - b.axis[0], a.axis[1] - b.axis[1], a.axis[2] - b.axis[2]))
+
+cdef inline vec3 vec3_mul(vec3 a, double scalar) noexcept nogil:
+    return(vec3_new(a.axis[0] * scalar, a.axis[1] * scalar, a.axis[2] * scalar))
+
+cdef inline double vec3_dot(vec3 a, vec3 b) noexcept nogil:
+    return(a.axis[0] * b.axis[0] + a.axis[1] * b.axis[1] + a.axis[2] * b.axis[2])
+
+cdef inline double vec3_length(vec3 a) noexcept nogil:
+    return(sqrt(vec3_dot(a, a)))
+
+cdef inline bint vec3_is_zero(vec3 a) noexcept nogil:
+    return(a.axis[0] == 0.0 and a.axis[1] == 0.0 and a.axis[2] == 0.0)
+
+cdef inline Point3d vec3_point(vec3 a):
+    """return new Point3d of vec3 a"""
+    cdef Point3d point = Point3d.__new__(Point3d)
+    point.X = a.axis[0]
+    point.Y = a.axis[1]
+    point.Z = a.axis[2]
+    return(point)
@@ -5,69 +5,94 @@
 #
 
 from libc.math cimport sin, cos, acos, sqrt, M_PI
+from cython.view cimport array as cvarray
+from cpython cimport array
+import array
 
 
 cdef class Point3d(object):
     """
     three dimension vetor representation
-    """
 
-    cdef public double X
-    cdef public double Y
-    cdef public double Z
+    attributes and C level vec3 functions are declared in Point3d.pxd
+    """
 
     def __init__(self, double x=0.0, double y=0.0, double z=0.0):
         self.X = x
         self.Y = y
         self.Z = z
 
-    cpdef get_axis(self, axisname):
-        return(getattr(self, axisname))
+    cdef vec3 vec(self):
+        """return self as C vector"""
+        return(vec3_new(self.X, self.Y, self.Z))
+
+    cpdef double get_axis(self, str axisname) except? -1:
+        if axisname == "X":
+            return(self.X)
+        elif axisname == "Y":
+            return(self.Y)
+        elif axisname == "Z":
+            return(self.Z)
+        raise AttributeError(axisname)
+
+    cpdef set_axis(self, str axisname, double value):
+        if axisname == "X":
+            self.X = value
+        elif axisname == "Y":
+            self.Y = value
+        elif axisname == "Z":
+            self.Z = value
+        else:
+            raise AttributeError(axisname)
 
-    cpdef set_axis(self, axisname, value):
-        return(setattr(self, axisname, value))
- 
     def __repr__(self):
         return("Point3d(%s, %s, %s)" % (self.X, self.Y, self.Z))
 
     def __str__(self):
         return("(%s, %s, %s)" % (self.X, self.Y, self.Z))
 
-    def __add__(self, other):
-        return(Point3d(self.X + other.X, self.Y + other.Y, self.Z + other.Z))
+    def __add__(Point3d self, Point3d other):
+        return(vec3_point(vec3_add(self.vec(), other.vec())))
 
-    def __iadd__(self, object other):
+    def __iadd__(self, Point3d other):
         self.X += other.X
         self.Y += other.Y
         self.Z += other.Z
+        return(self)
 
-    def __sub__(self, object other):
-        return(Point3d(self.X - other.X, self.Y - other.Y, self.Z - other.Z))
+    def __sub__(Point3d self, Point3d other):
+        return(vec3_point(vec3_sub(self.vec(), other.vec())))
 
-    def __isub__(self, object other):
+    def __isub__(self, Point3d other):
         self.X -= other.X
         self.Y -= other.Y
         self.Z -= other.Z
+        return(self)
 
-    def __mul__(self, double scalar):
-        return(Point3d(self.X * scalar, self.Y * scalar, self.Z * scalar))
+    def __mul__(Point3d self, double scalar):
+        return(vec3_point(vec3_mul(self.vec(), scalar)))
 
-    def __imul__(self, float scalar):
+    def __imul__(self, double scalar):
         self.X *= scalar
         self.Y *= scalar
         self.Z *= scalar
+        return(self)
+
+    def __div__(Point3d self, double scalar):
+        return(vec3_point(vec3_mul(self.vec(), 1.0 / scalar)))
 
-    def __div__(self, double scalar):
-        return(Point3d(self.X / scalar, self.Y / scalar, self.Z / scalar))
+    def __truediv__(Point3d self, double scalar):
+        return(vec3_point(vec3_mul(self.vec(), 1.0 / scalar)))
 
-    def __idiv__(self, float scalar):
+    def __idiv__(self, double scalar):
         self.X /= scalar
         self.Y /= scalar
         self.Z /= scalar
+        return(self)
 
     cpdef double length(self):
         """return length of vector"""
-        return(sqrt(self.X ** 2 + self.Y ** 2 + self.Z ** 2))
+        return(vec3_length(self.vec()))
 
     cpdef double lengthXY(self):
         """return length of vector"""
@@ -80,8 +105,7 @@ cdef class Point3d(object):
 
         length of unit vector is always 1
         """
-        length = self.length()
-        return(Point3d(self.X / length, self.Y / length, self.Z / length))
+        return(vec3_point(vec3_mul(self.vec(), 1.0 / self.length())))
 
     cpdef object product(self, object other):
         """
@@ -156,7 +180,8 @@ cdef class Point3d(object):
         """
         Dot Product of two vectors with the same number of items
         """
-        return(self.X * other.X + self.Y * other.Y + self.Z * other.Z)
+        cdef Point3d point = other
+        return(vec3_dot(self.vec(), point.vec()))
 
     cpdef double angle(self):
         """
@@ -179,3 +204,207 @@ cdef class Point3d(object):
         except ValueError as exc:
             print "Value Error, dot product not between -1 and 1, actually:%f" % dot
             raise(exc)
+
+
+cdef array.array DOUBLES = array.array("d")
+
+
+cdef array.array new_column(Py_ssize_t rows):
+    """return new uninitialized array.array of rows doubles"""
+    return(array.clone(DOUBLES, rows, False))
+
+
+cdef double[:, ::1] new_rows(Py_ssize_t rows):
+    """return new uninitialized array of rows * 3 doubles"""
+    return(cvarray(shape=(max(rows, 1), 3), itemsize=sizeof(double), format="d")[:rows])
+
+
+cdef class PointArray(object):
+    """
+    many three dimension vectors in one (N, 3) buffer of float64,
+    one row per vector, columns X, Y, Z
+
+    operations work like in Point3d, but on all rows in one C loop,
+    methods with one value per row return an array.array of N doubles.
+    numpy.asarray(points.data) or points.numpy() is a view without copy,
+    and a C contiguous (N, 3) float64 numpy array is used without copy too
+    """
+
+    def __init__(self, object points=0):
+        """
+        @params
+        points -> number of vectors, all zero, or (N, 3) float64 buffer
+            like a numpy array, used without copy, or sequence of Point3d
+            or (x, y, z) tuples
+        """
+        cdef Py_ssize_t index
+        cdef Point3d point
+        if isinstance(points, (int, long)):
+            self.data = new_rows(points)
+            self.data[:, :] = 0.0
+            return
+        try:
+            self.data = points
+            return
+        except (TypeError, ValueError, BufferError):
+            pass
+        points = list(points)
+        self.data = new_rows(len(points))
+        for index in range(len(points)):
+            if isinstance(points[index], Point3d):
+                point = points[index]
+                self.data[index, 0] = point.X
+                self.data[index, 1] = point.Y
+                self.data[index, 2] = point.Z
+            else:
+                self.data[index, 0], self.data[index, 1], self.data[index, 2] = points[index]
+
+    def __len__(self):
+        return(self.data.shape[0])
+
+    def __getitem__(self, Py_ssize_t index):
+        """return row index as new Point3d"""
+        if index < 0:
+            index += self.data.shape[0]
+        if not 0 <= index < self.data.shape[0]:
+            raise IndexError(index)
+        return(vec3_point(self.vec(index)))
+
+    def __setitem__(self, Py_ssize_t index, Point3d point):
+        if index < 0:
+            index += self.data.shape[0]
+        if not 0 <= index < self.data.shape[0]:
+            raise IndexError(index)
+        self.data[index, 0] = point.X
+        self.data[index, 1] = point.Y
+        self.data[index, 2] = point.Z
+
+    def __repr__(self):
+        return("PointArray([%s])" % ", ".join(str(self[index]) for index in range(len(self))))
+
+    cdef vec3 vec(self, Py_ssize_t index):
+        """return row index as C vector"""
+        return(vec3_new(self.data[index, 0], self.data[index, 1], self.data[index, 2]))
+
+    def numpy(self):
+        """return (N, 3) numpy array, view of the same buffer"""
+        import numpy
+        return(numpy.asarray(self.data))
+
+    def __add__(PointArray self, object other):
+        """add PointArray of same length, or Point3d to every row"""
+        return(self.combine(other, 1.0))
+
+    def __sub__(PointArray self, object other):
+        """subtract PointArray of same length, or Point3d from every row"""
+        return(self.combine(other, -1.0))
+
+    cdef PointArray combine(self, object other, double sign):
+        """return self + sign * other"""
+        cdef PointArray result = PointArray.__new__(PointArray)
+        cdef double[:, ::1] rows
+        cdef vec3 offset
+        cdef Py_ssize_t index, axis
+        result.data = new_rows(self.data.shape[0])
+        if isinstance(other, Point3d):
+            offset = (<Point3d>other).vec()
+            for index in range(self.data.shape[0]):
+                for axis in range(3):
+                    result.data[index, axis] = self.data[index, axis] + sign * offset.axis[axis]
+            return(result)
+        rows = (<PointArray?>other).data
+        if rows.shape[0] != self.data.shape[0]:
+            raise ValueError("PointArrays of different length %d and %d" % (self.data.shape[0], rows.shape[0]))
+        for index in range(self.data.shape[0]):
+            for axis in range(3):
+                result.data[index, axis] = self.data[index, axis] + sign * rows[index, axis]
+        return(result)
+
+    def __mul__(PointArray self, double scalar):
+        cdef PointArray result = PointArray.__new__(PointArray)
+        cdef Py_ssize_t index, axis
+        result.data = new_rows(self.data.shape[0])
+        for index in range(self.data.shape[0]):
+            for axis in range(3):
+                result.data[index, axis] = self.data[index, axis] * scalar
+        return(result)
+
+    cpdef object length(self):
+        """return length of every vector"""
+        cdef array.array result = new_column(self.data.shape[0])
+        cdef Py_ssize_t index
+        for index in range(self.data.shape[0]):
+            result.data.as_doubles[index] = vec3_length(self.vec(index))
+        return(result)
+
+    cpdef object lengthXY(self):
+        """return length of every vector in X/Y plane"""
+        cdef array.array result = new_column(self.data.shape[0])
+        cdef Py_ssize_t index
+        for index in range(self.data.shape[0]):
+            result.data.as_doubles[index] = sqrt(self.data[index, 0] ** 2 + self.data[index, 1] ** 2)
+        return(result)
+
+    cpdef PointArray unit(self):
+        """return unit vectors of all vectors"""
+        cdef PointArray result = PointArray.__new__(PointArray)
+        cdef Py_ssize_t index
+        cdef vec3 unit
+        result.data = new_rows(self.data.shape[0])
+        for index in range(self.data.shape[0]):
+            unit = vec3_mul(self.vec(index), 1.0 / vec3_length(self.vec(index)))
+            result.data[index, 0] = unit.axis[0]
+            result.data[index, 1] = unit.axis[1]
+            result.data[index, 2] = unit.axis[2]
+        return(result)
+
+    cpdef PointArray rotated_Z(self, double theta):
+        """
+        return all vectors rotated around Z-Axis, theta in radians,
+        see Point3d.rotated_Z
+        """
+        cdef PointArray result = PointArray.__new__(PointArray)
+        cdef double cos_theta = cos(theta)
+        cdef double sin_theta = sin(theta)
+        cdef Py_ssize_t index
+        result.data = new_rows(self.data.shape[0])
+        for index in range(self.data.shape[0]):
+            result.data[index, 0] = self.data[index, 0] * cos_theta - self.data[index, 1] * sin_theta
+            result.data[index, 1] = self.data[index, 0] * sin_theta + self.data[index, 1] * cos_theta
+            result.data[index, 2] = self.data[index, 2]
+        return(result)
+
+    cpdef object dot(self, object other):
+        """
+        return dot product of every row with Point3d other,
+        or with the same row of PointArray other
+        """
+        cdef array.array result = new_column(self.data.shape[0])
+        cdef Py_ssize_t index
+        cdef vec3 vector
+        cdef PointArray rows
+        if isinstance(other, Point3d):
+            vector = (<Point3d>other).vec()
+            for index in range(self.data.shape[0]):
+                result.data.as_doubles[index] = vec3_dot(self.vec(index), vector)
+            return(result)
+        rows = other
+        if rows.data.shape[0] != self.data.shape[0]:
+            raise ValueError("PointArrays of different length %d and %d" % (self.data.shape[0], rows.data.shape[0]))
+        for index in range(self.data.shape[0]):
+            result.data.as_doubles[index] = vec3_dot(self.vec(index), rows.vec(index))
+        return(result)
+
+    cpdef object angle(self):
+        """
+        return angle of every unit vector from his origin, see Point3d.angle
+        """
+        cdef array.array result = new_column(self.data.shape[0])
+        cdef Py_ssize_t index
+        for index in range(self.data.shape[0]):
+            # corect angle if in 3rd or 4th quadrant
+            if self.data[index, 1] < 0:
+                result.data.as_doubles[index] = 2 * M_PI - acos(self.data[index, 0])
+            else:
+                result.data.as_doubles[index] = acos(self.data[index, 0])
+        return(result)
@@ -0,0 +1,133 @@
+#/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# parse Gcode
+#
+"""
+Packed Buffer of Motor Steps for Controller
+"""
+from cpython cimport array
+from cpython.bytes cimport PyBytes_FromStringAndSize
+import array
+# own modules
+from BaseMotor import StepTimer as StepTimer
+from BaseMotor import execute_steps as execute_steps
+
+# bits of event, step on axis X, Y, Z and direction of this step
+cdef enum:
+    STEP_X = 1
+    STEP_Y = 2
+    STEP_Z = 4
+    REVERSE_X = 16
+    REVERSE_Y = 32
+    REVERSE_Z = 64
+
+
+cpdef bytes array_bytes(array.array values):
+    """
+    return raw bytes of array values,
+    like tobytes in python 3 and tostring in python 2
+    """
+    return(PyBytes_FromStringAndSize(values.data.as_chars, len(values) * values.itemsize))
+
+
+cpdef int extend_bytes(array.array values, bytes data) except -1:
+    """
+    append raw bytes data to array values,
+    like frombytes in python 3 and fromstring in python 2
+    """
+    if len(data) % values.itemsize != 0:
+        raise ValueError("bytes length is not a multiple of item size")
+    array.extend_buffer(values, data, len(data) // values.itemsize)
+    return(0)
+
+
+cdef class StepBuffer(object):
+    """
+    Run length encoded motor steps, struct of arrays
+
+    events -> array of unsigned char, bit 0-2 step on axis X, Y, Z,
+        bit 4-6 this step is in negative direction
+    counts -> array of unsigned int, how often event is repeated
+    delays -> array of float, seconds to wait before every repetition
+
+    one run needs 9 bytes, instead of one tuple with bound method and
+    args tuple per motor call
+    """
+
+    cdef public array.array events
+    cdef public array.array counts
+    cdef public array.array delays
+    cdef Py_ssize_t runs
+    cdef unsigned long steps
+
+    def __init__(self):
+        self.events = array.array("B")
+        self.counts = array.array("I")
+        self.delays = array.array("f")
+        self.runs = 0
+        self.steps = 0
+
+    def __len__(self):
+        """number of ticks, not runs"""
+        return(self.steps)
+
+    cpdef int append(self, unsigned char event, float delay) except -1:
+        """
+        append one tick, event is a combination of STEP_ and REVERSE_ bits
+        """
+        if self.runs > 0 and self.events.data.as_uchars[self.runs - 1] == event and self.delays.data.as_floats[self.runs - 1] == delay:
+            self.counts.data.as_uints[self.runs - 1] += 1
+        else:
+            array.resize_smart(self.events, self.runs + 1)
+            array.resize_smart(self.counts, self.runs + 1)
+            array.resize_smart(self.delays, self.runs + 1)
+            self.events.data.as_uchars[self.runs] = event
+            self.counts.data.as_uints[self.runs] = 1
+            self.delays.data.as_floats[self.runs] = delay
+            self.runs += 1
+        self.steps += 1
+        return(0)
+
+    cpdef int extend(self, bytes events, bytes counts, bytes delays) except -1:
+        """
+        append runs given as raw bytes of unsigned char, unsigned int and float arrays
+        """
+        cdef Py_ssize_t index
+        extend_bytes(self.events, events)
+        extend_bytes(self.counts, counts)
+        extend_bytes(self.delays, delays)
+        # only new runs are added to steps
+        for index in range(self.runs, len(self.counts)):
+            self.steps += self.counts.data.as_uints[index]
+        self.runs = len(self.events)
+        return(0)
+
+    cpdef long nbytes(self):
+        """return memory used by arrays in bytes"""
+        return(self.runs * (self.events.itemsize + self.counts.itemsize + self.delays.itemsize))
+
+    cpdef int run(self, object scheduler, object stop=None, object timer=None):
+        """
+        execute all steps with StepScheduler scheduler,
+        on the timeline of StepTimer timer, if given,
+        returns early if threading.Event stop is set
+        if all motors are native, steps are done with GIL released
+        """
+        cdef Py_ssize_t index
+        cdef unsigned int count
+        cdef unsigned char event
+        if timer is None:
+            timer = StepTimer()
+        if scheduler.is_native():
+            return(execute_steps(scheduler.motors, self, stop, timer))
+        timer.start()
+        for index in range(self.runs):
+            event = self.events.data.as_uchars[index]
+            for count in range(self.counts.data.as_uints[index]):
+                if stop is not None and stop.is_set():
+                    return(0)
+                # tick should not be before its planned time
+                timer.wait(self.delays.data.as_floats[index])
+                scheduler.tick(event)
+        return(0)
@@ -0,0 +1,275 @@
+#/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# parse Gcode
+#
+"""
+Step Executor Process
+
+motor steps are executed in a separate process, which owns the motor
+and spindle objects, fed by a ring buffer in shared memory
+"""
+import os
+import time
+import signal
+import ctypes
+import logging
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+import multiprocessing
+# own modules
+from StepScheduler import StepScheduler as StepScheduler
+from BaseMotor import StepTimer as StepTimer
+
+# full memory barrier, records in shared memory have to be complete
+# before HEAD or TAIL tell the other process about them
+cdef extern from *:
+    """
+    static inline void memory_barrier(void) { __sync_synchronize(); }
+    """
+    void memory_barrier() noexcept nogil
+
+# bits of event, like in StepBuffer, and control records
+cdef enum:
+    STEP_X = 1
+    STEP_Y = 2
+    STEP_Z = 4
+    CALL = 8
+    REVERSE_X = 16
+    REVERSE_Y = 32
+    REVERSE_Z = 64
+    END = 128
+
+# index in shared state
+cdef enum:
+    HEAD = 0 # next record to write
+    TAIL = 1 # next record to execute
+    UNDERRUNS = 2 # how often the buffer ran empty while executing
+    TICKS = 3 # ticks executed
+    STOPPED = 4 # set to stop executor
+    JITTER_MAX = 0 # maximum lateness of a tick in seconds
+    JITTER_SUM = 1 # sum of lateness of all ticks
+
+
+cdef int execute_ring(list objects, object scheduler, object timer, unsigned char[:] events, unsigned int[:] counts, float[:] delays, long long[:] state, double[:] jitter, object control) except -1:
+    """
+    execute records of ring buffer until END record
+    """
+    cdef Py_ssize_t capacity = events.shape[0]
+    cdef Py_ssize_t slot
+    cdef long long tail
+    cdef unsigned int count
+    cdef unsigned char event
+    cdef double lateness
+    cdef int empty = False
+    while not state[STOPPED]:
+        tail = state[TAIL]
+        if tail == state[HEAD]:
+            # only an underrun if steps were executed before
+            if not empty and state[TICKS] > 0:
+                state[UNDERRUNS] += 1
+            empty = True
+            time.sleep(0.0005)
+            continue
+        if empty:
+            # continue timeline from now, not from before the underrun
+            timer.start()
+            empty = False
+        # read record only after HEAD
+        memory_barrier()
+        slot = tail % capacity
+        event = events[slot]
+        if event & END:
+            memory_barrier()
+            state[TAIL] = tail + 1
+            break
+        if event & CALL:
+            (index, function, args) = control.get()
+            getattr(objects[index], function)(*args)
+            timer.start()
+        else:
+            for count in range(counts[slot]):
+                if state[STOPPED]:
+                    break
+                # tick should not be before its planned time
+                lateness = timer.wait(delays[slot])
+                if lateness > jitter[JITTER_MAX]:
+                    jitter[JITTER_MAX] = lateness
+                jitter[JITTER_SUM] += lateness
+                scheduler.tick(event)
+                state[TICKS] += 1
+        # slot is free again after record is read
+        memory_barrier()
+        state[TAIL] = tail + 1
+    return(0)
+
+
+def execute(factory, events, counts, delays, state, jitter, control, cpu, priority):
+    """
+    main function of executor process
+    """
+    # KeyboardInterrupt is handled by the parent process, see abort()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if cpu is not None:
+        try:
+            os.sched_setaffinity(0, [cpu])
+        except (AttributeError, OSError) as exc:
+            logging.error("could not bind executor to cpu %s : %s", cpu, exc)
+    if priority is not None:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        except (AttributeError, OSError) as exc:
+            logging.error("could not set SCHED_FIFO priority %s : %s", priority, exc)
+    created = factory()
+    objects = [created.get(name) for name in ("X", "Y", "Z", "spindle")]
+    scheduler = StepScheduler()
+    for axis in range(3):
+        scheduler.set_motor(axis, objects[axis])
+    execute_ring(objects, scheduler, StepTimer(), events, counts, delays, state, jitter, control)
+
+
+cdef class StepExecutor(object):
+    """
+    Class to execute motor steps in a separate process
+
+    the process creates its own motor and spindle objects by calling factory,
+    which should return a dict with keys X, Y, Z and spindle, so
+    GPIO and ShiftRegister objects only live in the executor process
+
+    runs of StepBuffers are copied to a ring buffer of capacity records
+    in shared memory, method calls to motors and spindle are passed through
+    a queue and executed in order with the steps.
+
+    planning, logging and GUI in this process can not delay a step,
+    as long as the ring buffer does not run empty, see underruns
+
+    after abort the executor process ends, and every further push
+    or call raises RuntimeError, a new StepExecutor is needed,
+    the same if the executor process died of an exception
+    """
+
+    cdef object events
+    cdef object counts
+    cdef object delays
+    cdef object state
+    cdef object jitter
+    cdef object control
+    cdef object process
+    cdef Py_ssize_t capacity
+
+    def __init__(self, factory, Py_ssize_t capacity=65536, cpu=None, priority=None):
+        """
+        @params
+        factory -> function returning dict of motors X, Y, Z and spindle,
+            called in executor process
+        capacity -> number of records in ring buffer
+        cpu -> if given, bind executor process to this cpu
+        priority -> if given, run executor process with SCHED_FIFO and this priority
+        """
+        self.capacity = capacity
+        self.events = multiprocessing.RawArray(ctypes.c_ubyte, capacity)
+        self.counts = multiprocessing.RawArray(ctypes.c_uint, capacity)
+        self.delays = multiprocessing.RawArray(ctypes.c_float, capacity)
+        self.state = multiprocessing.RawArray(ctypes.c_longlong, 5)
+        self.jitter = multiprocessing.RawArray(ctypes.c_double, 2)
+        self.control = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=execute, args=(factory, self.events, self.counts, self.delays, self.state, self.jitter, self.control, cpu, priority))
+        self.process.daemon = True
+        self.process.start()
+
+    cdef int put(self, unsigned char event, unsigned int count, float delay) except -1:
+        """
+        write one record to ring buffer, wait if it is full
+        """
+        cdef long long[:] state = self.state
+        cdef long long head = state[HEAD]
+        cdef Py_ssize_t slot = head % self.capacity
+        cdef unsigned char[:] events = self.events
+        cdef unsigned int[:] counts = self.counts
+        cdef float[:] delays = self.delays
+        self.check()
+        while head - state[TAIL] >= self.capacity:
+            self.check()
+            time.sleep(0.001)
+        # slot is free, write it only after TAIL
+        memory_barrier()
+        events[slot] = event
+        counts[slot] = count
+        delays[slot] = delay
+        # record is complete, make it visible to executor
+        memory_barrier()
+        state[HEAD] = head + 1
+        return(0)
+
+    cdef int check(self) except -1:
+        """raise RuntimeError if executor was aborted or its process died"""
+        cdef long long[:] state = self.state
+        if state[STOPPED]:
+            raise RuntimeError("executor was aborted, a new StepExecutor is needed")
+        if not self.process.is_alive():
+            raise RuntimeError("executor process died with exit code %s" % self.process.exitcode)
+        return(0)
+
+    cpdef int push(self, object buffer, object stop=None) except -1:
+        """
+        append all steps of StepBuffer buffer to ring buffer,
+        stop like in StepBuffer.run
+        """
+        cdef const unsigned char[:] events = buffer.events
+        cdef const unsigned int[:] counts = buffer.counts
+        cdef const float[:] delays = buffer.delays
+        cdef Py_ssize_t index
+        for index in range(events.shape[0]):
+            if stop is not None and stop.is_set():
+                break
+            self.put(events[index], counts[index], delays[index])
+        return(0)
+
+    def call(self, str name, str function, *args):
+        """
+        call function of motor X, Y, Z or spindle in executor process,
+        after all steps before
+        """
+        self.check()
+        self.control.put(("XYZ".index(name) if name != "spindle" else 3, function, args))
+        self.put(CALL, 0, 0.0)
+
+    def abort(self):
+        """
+        stop executor process as soon as possible,
+        this executor can not be used any more
+        """
+        cdef long long[:] state = self.state
+        state[STOPPED] = True
+
+    def join(self):
+        """
+        wait until all records are executed, and stop executor process
+        on KeyboardInterrupt the executor process is stopped at once
+        """
+        cdef long long[:] state = self.state
+        try:
+            if not state[STOPPED] and self.process.is_alive():
+                self.put(END, 0, 0.0)
+            # join with timeout, so KeyboardInterrupt is delivered
+            while self.process.is_alive():
+                self.process.join(0.1)
+        except KeyboardInterrupt:
+            self.abort()
+            self.process.join()
+            raise
+
+    def stats(self):
+        """
+        return counters of executor process
+        underruns -> how often the ring buffer ran empty after the first tick
+        ticks -> number of executed ticks
+        jitter_max, jitter_mean -> lateness of ticks in seconds
+        """
+        cdef long long[:] state = self.state
+        cdef double[:] jitter = self.jitter
+        return({
+            "underruns" : state[UNDERRUNS],
+            "ticks" : state[TICKS],
+            "jitter_max" : jitter[JITTER_MAX],
+            "jitter_mean" : jitter[JITTER_SUM] / state[TICKS] if state[TICKS] > 0 else 0.0,
+        })
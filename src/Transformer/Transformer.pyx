@@ -6,11 +6,27 @@
 """
 Classes to Transfor motions in X/Y/Z to other dimensions
 """
+import os
 import math
+import struct
+import hashlib
 import logging
 logging.basicConfig(level=logging.INFO, format="%(message)s")
+from cpython cimport array
+import array
 # own modules
-from Point3d import Point3d as Point3d
+from Point3d cimport Point3d, PointArray, vec3, vec3_new, vec3_add, vec3_sub, vec3_point
+from StepBuffer import array_bytes as array_bytes
+from StepBuffer import extend_bytes as extend_bytes
+from libc.math cimport hypot, ceil, sqrt, fmax, sin, cos
+
+# file format version of stored lookup grids, change if layout changes
+LOOKUP_VERSION = 1
+LOOKUP_MAGIC = b"PLOTGRID"
+# header, format version, nodes in x and y
+LOOKUP_HEADER = struct.Struct("=%dsIII" % len(LOOKUP_MAGIC))
+# upper limit of grid nodes, 2 doubles each
+MAX_LOOKUP_NODES = 4 * 1024 * 1024
 
 
 cdef class Transformer(object):
@@ -19,26 +35,185 @@ cdef class Transformer(object):
     this is the simple pass-through version, no modification is done to the
     motion values
     this class is also the base class for every custom Transformer
+
+    if absolute is set, the controller calls transform_position with
+    absolute positions instead of transform with every move, the result
+    does not depend on the moves before, so there is no drift, and parts
+    of a toolpath can be planned independently
+
+    affine stages like scaling, rotation, offset and mirroring are
+    added with add_scale, add_rotation, add_offset, add_mirror or
+    add_affine, all of them are multiplied into one matrix when added,
+    so every position is multiplied only once, however many stages
+    there are, non-linear subclasses apply their own stage after it
     """
 
     cdef float scale
     cdef object gui_cb
+    cdef public int absolute
+    # all affine stages, rows of a 4x4 matrix without the last row 0, 0, 0, 1
+    cdef double affine[3][4]
+    cdef int identity
+    # own absolute position, and motor positions there
+    cdef vec3 position
+    cdef vec3 lengths
 
-    def __init__(self, float scale=1.0):
+    def __init__(self, float scale=1.0, int absolute=False):
         self.scale = scale
         self.gui_cb = None
+        self.absolute = absolute
+        self.position = vec3_new(0.0, 0.0, 0.0)
+        self.lengths = vec3_new(0.0, 0.0, 0.0)
+        self.reset_affine()
 
     cpdef int set_gui_cb(self, gui_cb):
         self.gui_cb = gui_cb
 
+    cpdef int reset_affine(self):
+        """remove all affine stages"""
+        cdef int row, column
+        for row in range(3):
+            for column in range(4):
+                self.affine[row][column] = 1.0 if row == column else 0.0
+        self.identity = True
+        return(0)
+
+    cpdef int add_affine(self, object matrix):
+        """
+        append affine stage, applied after all stages added before
+
+        @params
+        matrix -> 4x4 matrix as nested sequences, last row has to be 0, 0, 0, 1
+        """
+        cdef double combined[3][4]
+        cdef int row, column, index
+        assert len(matrix) == 4
+        for row in range(4):
+            assert len(matrix[row]) == 4
+        assert tuple(matrix[3]) == (0, 0, 0, 1), "last row of affine matrix has to be 0, 0, 0, 1"
+        for row in range(3):
+            for column in range(4):
+                combined[row][column] = matrix[row][3] if column == 3 else 0.0
+                for index in range(3):
+                    combined[row][column] += matrix[row][index] * self.affine[index][column]
+        for row in range(3):
+            for column in range(4):
+                self.affine[row][column] = combined[row][column]
+                if combined[row][column] != (1.0 if row == column else 0.0):
+                    self.identity = False
+        return(0)
+
+    cpdef int add_scale(self, double x, double y, double z=1.0):
+        """append scaling of every axis"""
+        return(self.add_affine(((x, 0, 0, 0), (0, y, 0, 0), (0, 0, z, 0), (0, 0, 0, 1))))
+
+    cpdef int add_rotation(self, double theta):
+        """append rotation around Z-Axis, theta in radians"""
+        return(self.add_affine(((cos(theta), -sin(theta), 0, 0), (sin(theta), cos(theta), 0, 0), (0, 0, 1, 0), (0, 0, 0, 1))))
+
+    cpdef int add_offset(self, double x, double y, double z=0.0):
+        """append offset, added to every position"""
+        return(self.add_affine(((1, 0, 0, x), (0, 1, 0, y), (0, 0, 1, z), (0, 0, 0, 1))))
+
+    cpdef int add_mirror(self, int x, int y, int z=False):
+        """append mirroring of the selected axes at zero"""
+        return(self.add_scale(-1.0 if x else 1.0, -1.0 if y else 1.0, -1.0 if z else 1.0))
+
+    cpdef object get_affine(self):
+        """return combined matrix of all affine stages as 4x4 nested lists"""
+        return([[self.affine[row][column] for column in range(4)] for row in range(3)] + [[0.0, 0.0, 0.0, 1.0]])
+
+    cdef inline vec3 apply_affine(self, double x, double y, double z):
+        """return position x, y, z after all affine stages"""
+        if self.identity:
+            return(vec3_new(x, y, z))
+        return(vec3_new(
+            self.affine[0][0] * x + self.affine[0][1] * y + self.affine[0][2] * z + self.affine[0][3],
+            self.affine[1][0] * x + self.affine[1][1] * y + self.affine[1][2] * z + self.affine[1][3],
+            self.affine[2][0] * x + self.affine[2][1] * y + self.affine[2][2] * z + self.affine[2][3]))
+
+    cdef vec3 motor_position(self, double x, double y, double z):
+        """
+        return position of motors at absolute position x, y, z,
+        subclasses apply their own stage to the result of apply_affine
+        """
+        return(self.apply_affine(x, y, z))
+
+    cdef object move(self, object data):
+        """
+        add vector data of type Point3d to own position, and return
+        the vector between the motor positions before and after,
+        motor positions are calculated from the absolute position,
+        so rounding errors do not add up over many calls
+        """
+        cdef Point3d vector = data
+        cdef vec3 lengths
+        self.position = vec3_add(self.position, vector.vec())
+        lengths = self.motor_position(self.position.axis[0], self.position.axis[1], self.position.axis[2])
+        transformed = vec3_point(vec3_sub(lengths, self.lengths))
+        self.lengths = lengths
+        self.gui_cb(data, transformed)
+        return(transformed)
+
     cpdef object transform(self, object data):
         """
-        this is only generic tranformer with no action
+        without affine stages this is only generic tranformer with no action,
+        offsets move the motors at the first call
         """
         #logging.debug("transform called with %s", data)
+        if not self.identity:
+            return(self.move(data))
         self.gui_cb(data, data)
         return(data)
 
+    cpdef int is_linear(self):
+        """
+        True if straight lines stay straight lines in motor positions,
+        otherwise the controller splits moves into smaller segments,
+        and transform_position and transform_batch have to be implemented
+        """
+        return(True)
+
+    cpdef object transform_position(self, object position):
+        """
+        transform absolute position of type Point3d into absolute
+        position of motors, without own state,
+        like transform would return summed up from null-position
+        """
+        cdef Point3d point = position
+        if self.identity:
+            self.gui_cb(position, position)
+            return(position)
+        transformed = vec3_point(self.motor_position(point.X, point.Y, point.Z))
+        self.gui_cb(position, transformed)
+        return(transformed)
+
+    cpdef PointArray transform_batch(self, object points):
+        """
+        transform absolute positions, PointArray or (N, 3) float64 array
+        like a numpy array, into absolute positions of motors,
+        in one C loop, without changing own position and without gui_cb,
+        returns new PointArray
+        """
+        cdef PointArray positions = points if isinstance(points, PointArray) else PointArray(points)
+        if self.identity:
+            return(positions + Point3d(0.0, 0.0, 0.0))
+        return(self.motor_batch(positions))
+
+    cdef PointArray motor_batch(self, PointArray positions):
+        """return new PointArray of motor_position of all positions"""
+        cdef PointArray result = PointArray(len(positions))
+        cdef double[:, ::1] source = positions.data
+        cdef double[:, ::1] target = result.data
+        cdef vec3 motor
+        cdef Py_ssize_t index
+        for index in range(source.shape[0]):
+            motor = self.motor_position(source[index, 0], source[index, 1], source[index, 2])
+            target[index, 0] = motor.axis[0]
+            target[index, 1] = motor.axis[1]
+            target[index, 2] = motor.axis[2]
+        return(result)
+
     cpdef get_scale(self):
         return(self.scale)
 
@@ -52,23 +227,73 @@ cdef class PlotterTransformer(Transformer):
     cdef int width
     cdef int ca_zero
     cdef int h_zero
-    cdef object position
-    cdef object offset_a
-    cdef object offset_b
-    cdef float zero_a
-    cdef float zero_b
-
-    def __init__(self, int width, float scale, int ca_zero, int h_zero):
-        Transformer.__init__(self, scale)
+    cdef double zero_a
+    cdef double zero_b
+    # optional lookup grid of motor positions a/b over the drawing area
+    cdef array.array grid
+    cdef double *nodes
+    cdef int grid_nx, grid_ny
+    cdef double grid_x, grid_y, grid_x_end, grid_y_end
+    cdef double grid_inv_dx, grid_inv_dy
+    cdef public double lookup_error
+
+    def __init__(self, int width, float scale, int ca_zero, int h_zero, int absolute=False):
+        Transformer.__init__(self, scale, absolute)
         self.scale = scale
-        # two null-position vectors, for motor a and b
-        self.offset_a = Point3d(ca_zero, h_zero, 0)
-        self.offset_b = Point3d(ca_zero - width, h_zero, 0)
-        # remember last length
-        self.zero_a = self.offset_a.lengthXY()
-        self.zero_b = self.offset_b.lengthXY()
-        # remember own position
-        self.position = Point3d(0, 0, 0)
+        self.width = width
+        self.ca_zero = ca_zero
+        self.h_zero = h_zero
+        # length of both cords at null-position, for motor a and b
+        self.zero_a = hypot(ca_zero, h_zero)
+        self.zero_b = hypot(ca_zero - width, h_zero)
+        self.grid = None
+        self.nodes = NULL
+        self.grid_nx = 0
+        self.grid_ny = 0
+        self.lookup_error = 0.0
+
+    cdef vec3 motor_position(self, double x, double y, double z):
+        """
+        return position of motors a/b/z at absolute position x, y, z,
+        length of cord a and b minus length at null-position,
+        after all affine stages
+
+        inside the lookup grid, if there is one, a and b are bilinear
+        interpolated from the four surrounding nodes
+        """
+        cdef double fx, fy, a, b
+        cdef double *node
+        cdef int ix, iy
+        cdef vec3 point = self.apply_affine(x, y, z)
+        x = point.axis[0]
+        y = point.axis[1]
+        z = point.axis[2]
+        if self.nodes != NULL and self.grid_x <= x <= self.grid_x_end and self.grid_y <= y <= self.grid_y_end:
+            fx = (x - self.grid_x) * self.grid_inv_dx
+            fy = (y - self.grid_y) * self.grid_inv_dy
+            ix = <int>fx
+            iy = <int>fy
+            # last row and column interpolate from the cell before
+            if ix > self.grid_nx - 2:
+                ix = self.grid_nx - 2
+            if iy > self.grid_ny - 2:
+                iy = self.grid_ny - 2
+            fx -= ix
+            fy -= iy
+            node = self.nodes + 2 * (iy * self.grid_nx + ix)
+            a = (1.0 - fy) * ((1.0 - fx) * node[0] + fx * node[2])
+            b = (1.0 - fy) * ((1.0 - fx) * node[1] + fx * node[3])
+            node += 2 * self.grid_nx
+            a += fy * ((1.0 - fx) * node[0] + fx * node[2])
+            b += fy * ((1.0 - fx) * node[1] + fx * node[3])
+            return(vec3_new(a, b, z * self.scale))
+        return(self.exact_position(x, y, z))
+
+    cdef inline vec3 exact_position(self, double x, double y, double z):
+        """motor_position calculated without lookup grid"""
+        cdef double a = hypot(self.ca_zero + x * self.scale, self.h_zero + y * self.scale)
+        cdef double b = hypot(self.ca_zero - self.width + x * self.scale, self.h_zero + y * self.scale)
+        return(vec3_new(a - self.zero_a, b - self.zero_b, z * self.scale))
 
     cpdef object transform(self, object data):
         """
@@ -108,23 +333,148 @@ cdef class PlotterTransformer(Transformer):
         the zero point is exactly in the middle of A and B at the bottom
         usually zero ion carthesian coordinates is in upper left corner,
         so y has to be subtracted from height, to go up
+
+        motor positions are calculated from the absolute position,
+        so rounding errors do not add up over many calls
         """
-        #logging.info("last vector a: %s (%s)", self.offset_a, self.zero_a)
-        #logging.info("last vector b: %s (%s)", self.offset_b, self.zero_b)
-        #logging.info("moving about vector %s", data)
-        a = self.offset_a + data * self.scale
-        b = self.offset_b + data * self.scale
-        l_a = a.lengthXY()
-        l_b = b.lengthXY()
-        #logging.info("new vector a: %s (%s)", a, l_a)
-        #logging.info("new vector b: %s (%s)", b, l_b)
-        l_a -= self.zero_a
-        l_b -= self.zero_b
-        transformed = Point3d(l_a, l_b, data.Z * self.scale)
-        #logging.info("transformation %s -> %s", data, transformed)
-        self.offset_a = a
-        self.offset_b = b
-        self.zero_a += l_a
-        self.zero_b += l_b
-        self.gui_cb(data, transformed)
+        return(self.move(data))
+
+    cpdef int is_linear(self):
+        """cord lengths are not linear in x and y"""
+        return(False)
+
+    cdef double anchor_distance(self, double x_min, double y_min, double x_max, double y_max):
+        """
+        return smallest distance of both cord anchors to the area
+        x_min/y_min - x_max/y_max, in scaled units
+        """
+        cdef double distance = 0.0
+        cdef double anchor_x, dx, dy
+        # anchors relative to null-position, before scaling
+        for anchor_x in (-self.ca_zero / self.scale, (self.width - self.ca_zero) / self.scale):
+            dx = fmax(fmax(x_min - anchor_x, anchor_x - x_max), 0.0)
+            dy = fmax(fmax(y_min + self.h_zero / self.scale, -self.h_zero / self.scale - y_max), 0.0)
+            if distance == 0.0 or hypot(dx, dy) < distance:
+                distance = hypot(dx, dy)
+        return(distance * self.scale)
+
+    cpdef int set_lookup(self, double x_min, double y_min, double x_max, double y_max, double max_error=0.01, object directory=None):
+        """
+        precompute motor positions a/b on a grid over the drawing area,
+        motor_position interpolates bilinear between the nodes of the grid,
+        positions outside the area are calculated exactly
+
+        the error of bilinear interpolation in one cell is at most
+        dx^2 / 8 * max(|d2a/dx2|) + dy^2 / 8 * max(|d2a/dy2|), for a cord
+        of length r both second derivatives are at most scale^2 / r,
+        so the node distance is chosen from the shortest cord in the area
+        to stay within max_error
+
+        @params
+        x_min, y_min, x_max, y_max -> drawing area in positions after all affine stages
+        max_error -> maximum error of a/b in motor positions, like transform returns
+        directory -> if set, grids are stored there and loaded again,
+            keyed by geometry, area and max_error
+        """
+        cdef double distance, spacing
+        cdef int nx, ny, ix, iy
+        cdef array.array grid
+        cdef vec3 motor
+        assert x_max > x_min and y_max > y_min
+        assert max_error > 0.0
+        distance = self.anchor_distance(x_min, y_min, x_max, y_max)
+        if distance <= 0.0:
+            raise ValueError("a cord anchor is inside the lookup area")
+        # same node distance in x and y, error at most 2 * spacing^2 / 8 * scale^2 / distance
+        spacing = sqrt(4.0 * max_error * distance) / self.scale
+        nx = <int>ceil((x_max - x_min) / spacing) + 1
+        ny = <int>ceil((y_max - y_min) / spacing) + 1
+        if nx * <long>ny > MAX_LOOKUP_NODES:
+            raise ValueError("lookup grid of %d x %d nodes is too large, raise max_error" % (nx, ny))
+        key = self.lookup_key(x_min, y_min, x_max, y_max, max_error)
+        grid = self.load_lookup(directory, key, nx, ny) if directory is not None else None
+        if grid is None:
+            grid = array.clone(array.array("d"), 2 * nx * ny, zero=False)
+            for iy in range(ny):
+                for ix in range(nx):
+                    motor = self.exact_position(x_min + (x_max - x_min) * ix / (nx - 1), y_min + (y_max - y_min) * iy / (ny - 1), 0.0)
+                    grid.data.as_doubles[2 * (iy * nx + ix)] = motor.axis[0]
+                    grid.data.as_doubles[2 * (iy * nx + ix) + 1] = motor.axis[1]
+            if directory is not None:
+                self.store_lookup(directory, key, nx, ny, grid)
+        self.grid = grid
+        self.nodes = grid.data.as_doubles
+        self.grid_nx = nx
+        self.grid_ny = ny
+        self.grid_x = x_min
+        self.grid_y = y_min
+        self.grid_x_end = x_max
+        self.grid_y_end = y_max
+        self.grid_inv_dx = (nx - 1) / (x_max - x_min)
+        self.grid_inv_dy = (ny - 1) / (y_max - y_min)
+        self.lookup_error = ((x_max - x_min) ** 2 / (nx - 1) ** 2 + (y_max - y_min) ** 2 / (ny - 1) ** 2) * self.scale ** 2 / (8.0 * distance)
+        logging.info("lookup grid %d x %d nodes, maximum error %f", nx, ny, self.lookup_error)
+        return(0)
+
+    cpdef int clear_lookup(self):
+        """calculate all motor positions exactly again"""
+        self.grid = None
+        self.nodes = NULL
+        self.grid_nx = 0
+        self.grid_ny = 0
+        self.lookup_error = 0.0
+        return(0)
+
+    cdef str lookup_key(self, double x_min, double y_min, double x_max, double y_max, double max_error):
+        """return hash of geometry and lookup parameters"""
+        digest = hashlib.sha1()
+        digest.update(("%d:%d:%d:%d:%r:%r:%r:%r:%r:%r" % (LOOKUP_VERSION, self.width, self.ca_zero, self.h_zero, <double>self.scale, x_min, y_min, x_max, y_max, max_error)).encode("ascii"))
+        return(str(digest.hexdigest()))
+
+    cdef object load_lookup(self, str directory, str key, int nx, int ny):
+        """return stored grid of key, or None if there is no valid one"""
+        cdef str path = os.path.join(directory, "%s.grid" % key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except (IOError, OSError):
+            return(None)
+        if len(data) != LOOKUP_HEADER.size + 16 * nx * ny or LOOKUP_HEADER.unpack_from(data, 0) != (LOOKUP_MAGIC, LOOKUP_VERSION, nx, ny):
+            logging.error("ignoring invalid lookup grid %s", path)
+            return(None)
+        grid = array.array("d")
+        extend_bytes(grid, data[LOOKUP_HEADER.size:])
+        return(grid)
+
+    cdef int store_lookup(self, str directory, str key, int nx, int ny, array.array grid) except -1:
+        """store grid under key"""
+        cdef str path = os.path.join(directory, "%s.grid" % key)
+        cdef str temp_path = "%s.%d" % (path, os.getpid())
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(temp_path, "wb") as f:
+            f.write(LOOKUP_HEADER.pack(LOOKUP_MAGIC, LOOKUP_VERSION, nx, ny))
+            f.write(array_bytes(grid))
+        os.rename(temp_path, path)
+        return(0)
+
+    cpdef object transform_position(self, object position):
+        """
+        transform absolute position of type Point3d into absolute motor
+        positions a/b/z, like transform would return summed up from
+        null-position, without changing own position
+        """
+        cdef Point3d point = position
+        transformed = vec3_point(self.motor_position(point.X, point.Y, point.Z))
+        self.gui_cb(position, transformed)
         return(transformed)
+
+    cpdef PointArray transform_batch(self, object points):
+        """
+        transform absolute positions, PointArray or (N, 3) float64 array
+        like a numpy array, into absolute motor positions a/b/z, like
+        transform would return summed up from null-position,
+        in one C loop, without changing own position and without gui_cb
+        """
+        cdef PointArray positions = points if isinstance(points, PointArray) else PointArray(points)
+        return(self.motor_batch(positions))
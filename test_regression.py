@@ -0,0 +1,153 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# parse Gcode
+#
+"""
+Regression check of the fast paths against the original implementations,
+runs without hardware, on all examples/*.ngc files
+
+Parser -> the calls of iter_commands() and read_program() are
+    compared with the regular expression parser of the first versions
+SegmentPlanner -> the motor steps planned for every tick are compared with
+    the integer DDA of Controller, used if numpy is not available,
+    for Transformer and PlotterTransformer
+
+run after setup.py build_ext --inplace
+python test_regression.py
+"""
+import os
+import re
+import glob
+import logging
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+# own modules
+import Controller
+from Parser import Parser
+from BaseMotor import BaseMotor
+from BaseSpindle import BaseSpindle
+from Transformer import Transformer, PlotterTransformer
+
+EXAMPLES = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples", "*.ngc")))
+
+
+class Motor(BaseMotor):
+    """motor without hardware, motor commands are only collected, never run"""
+
+    def unhold(self):
+        return(0)
+
+
+def regex_calls(filename):
+    """
+    parse filename like the regular expression Parser.read() before
+    the single pass lexer, returns list of (methodname, args)
+    """
+    calls = []
+    last_g_code = ""
+    g_params = ("X", "Y", "Z", "I", "J", "K", "P", "R", "U", "V", "W", "A", "B", "C")
+    rex_g = dict((g_param, re.compile(r"(%s[\+\-]?[\d\.]+)\D?" % g_param)) for g_param in g_params)
+    codes_rex = re.compile(r"([F|S|T][\d|\.]+)\D?")
+    gcodes_rex = re.compile(r"([G|M][\d|\.]+)\D?")
+    for line in open(filename, "r"):
+        line = line.strip().upper()
+        if len(line) == 0 or line[0] == "%" or line[0] == "(":
+            continue
+        params = {}
+        for parameter in g_params:
+            match = rex_g[parameter].search(line)
+            if match:
+                params[parameter] = float(match.group(1)[1:])
+                line = line.replace(match.group(1), "")
+        # Feed Rate has precedence over G
+        for code in codes_rex.findall(line):
+            calls.append((code[0], code[1:]))
+            line = line.replace(code, "")
+        gcodes = gcodes_rex.findall(line)
+        if len(params) > 0 and len(gcodes) == 0:
+            gcodes.append(last_g_code)
+        for code in gcodes:
+            calls.append((code, params))
+            if code[0] == "G":
+                last_g_code = code
+    return(calls)
+
+
+def program_calls(program):
+    """
+    return list of (methodname, args) of packed Program,
+    values of F, S and T Codes are floats in a Program
+    """
+    return([(program.names[program.opcodes[index]], program.args(index)) for index in range(len(program))])
+
+
+def float_codes(calls):
+    """return calls with values of F, S and T Codes as floats"""
+    return([(methodname, float(args) if methodname in ("F", "S", "T") else args) for (methodname, args) in calls])
+
+
+def test_parser():
+    """compare Parser with regular expression parser"""
+    for filename in EXAMPLES:
+        expected = regex_calls(filename)
+        for use_mmap in (False, True):
+            parser = Parser(filename, False, use_mmap)
+            parser.set_gui_cb(lambda: None)
+            calls = [(methodname, args) for (method_to_call, args, methodname) in parser.iter_commands()]
+            assert calls == expected, "%s iter_commands() differs, mmap=%s" % (filename, use_mmap)
+            parser = Parser(filename, False, use_mmap)
+            parser.set_gui_cb(lambda: None)
+            calls = program_calls(parser.read_program())
+            assert calls == float_codes(expected), "%s read_program() differs, mmap=%s" % (filename, use_mmap)
+        logging.info("%s : %d calls ok", os.path.basename(filename), len(expected))
+
+
+def motor_ticks(filename, transformer, planner):
+    """
+    return list of motor step events, one per tick, of filename
+    planner -> use SegmentPlanner, otherwise the DDA of Controller,
+        like without numpy
+    """
+    segment_planner = Controller.SegmentPlanner
+    if not planner:
+        Controller.SegmentPlanner = None
+    try:
+        controller = Controller.Controller(resolution=1.0, default_speed=1, autorun=False)
+    finally:
+        Controller.SegmentPlanner = segment_planner
+    for axis in ("X", "Y", "Z"):
+        controller.add_motor(axis, Motor(max_position=10**9, min_position=-10**9, delay=0.0, sos_exception=False))
+    controller.add_spindle(BaseSpindle())
+    transformer.set_gui_cb(lambda *args: None)
+    controller.add_transformer(transformer)
+    controller.set_gui_cb(lambda: None)
+    parser = Parser(filename, False)
+    parser.set_controller(controller)
+    parser.set_gui_cb(lambda: None)
+    controller.consume_program(parser.read_program())
+    ticks = []
+    for (method_to_call, args) in controller.drain():
+        steps = getattr(method_to_call, "__self__", None)
+        if hasattr(steps, "events"):
+            for (event, count) in zip(steps.events, steps.counts):
+                ticks.extend([event] * count)
+    return(ticks)
+
+
+def test_planner():
+    """compare SegmentPlanner steps with DDA steps"""
+    if Controller.SegmentPlanner is None:
+        logging.info("no SegmentPlanner without numpy, nothing to compare")
+        return
+    for filename in EXAMPLES:
+        for transformer in (Transformer, lambda: PlotterTransformer(width=830, scale=15.0, ca_zero=320, h_zero=140)):
+            expected = motor_ticks(filename, transformer(), False)
+            ticks = motor_ticks(filename, transformer(), True)
+            assert ticks == expected, "%s planned steps differ from DDA with %s" % (filename, transformer)
+        logging.info("%s : %d ticks ok", os.path.basename(filename), len(expected))
+
+
+if __name__ == "__main__":
+    test_parser()
+    test_planner()
+    logging.info("all ok")